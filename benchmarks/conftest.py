@@ -0,0 +1,54 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from csp_billing_adapter_amazon import plugin
+from csp_billing_adapter_amazon.fake_server import FakeAWSServer
+from csp_billing_adapter.config import Config
+from csp_billing_adapter.adapter import get_plugin_manager
+
+pm = get_plugin_manager()
+base_config = Config.load_from_file(
+    'tests/data/good_config.yaml',
+    pm.hook
+)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Fake endpoints with a round trip latency similar to AWS"""
+    with FakeAWSServer(latency=0.01, imds_latency=0.001, seed=1) as server:
+        monkeypatch.setenv('AWS_EC2_METADATA_SERVICE_ENDPOINT', server.url)
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+        plugin._reset()
+        yield server
+        plugin._reset()
+
+
+@pytest.fixture
+def make_config(server):
+    """Return a config pointing at the fake metering endpoint"""
+    def make_config(**options):
+        return Config({
+            **base_config,
+            'metering_endpoint_url': server.url,
+            'metering_retry_base_delay': 0.01,
+            **options
+        })
+
+    return make_config
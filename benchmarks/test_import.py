@@ -0,0 +1,74 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import pytest
+import subprocess
+import sys
+
+# Run in a fresh interpreter so nothing is imported yet
+IMPORT_SCRIPT = '''
+import json
+import resource
+import sys
+import time
+
+start = time.perf_counter()
+import {module}
+{statement}
+duration = time.perf_counter() - start
+
+print(json.dumps({{
+    'duration': duration,
+    'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'boto3': 'boto3' in sys.modules
+}}))
+'''
+
+
+def run_import(module, statement=''):
+    output = subprocess.check_output([
+        sys.executable,
+        '-c',
+        IMPORT_SCRIPT.format(module=module, statement=statement)
+    ])
+    return json.loads(output)
+
+
+@pytest.mark.parametrize('statement', [
+    pytest.param('', id='import'),
+    pytest.param(
+        'csp_billing_adapter_amazon.plugin._load_boto3()',
+        id='load_boto3'
+    )
+])
+def test_import_plugin(benchmark, statement):
+    results = []
+
+    def import_plugin():
+        results.append(
+            run_import('csp_billing_adapter_amazon.plugin', statement)
+        )
+
+    benchmark.pedantic(import_plugin, rounds=5)
+
+    benchmark.extra_info['import_seconds'] = min(
+        result['duration'] for result in results
+    )
+    benchmark.extra_info['max_rss_kb'] = max(
+        result['max_rss'] for result in results
+    )
+    assert all(result['boto3'] == bool(statement) for result in results)
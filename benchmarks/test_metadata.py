@@ -0,0 +1,62 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from conftest import base_config
+
+from csp_billing_adapter_amazon import plugin
+
+
+def test_get_region_cold(benchmark, server):
+    region = benchmark.pedantic(
+        plugin.get_region,
+        setup=plugin._reset,
+        rounds=50
+    )
+
+    assert region == 'us-east-1'
+
+
+def test_get_region_warm(benchmark, server):
+    plugin.get_region()
+    region = benchmark(plugin.get_region)
+
+    assert region == 'us-east-1'
+
+
+def test_get_account_info_cold(benchmark, server):
+    info = benchmark.pedantic(
+        plugin.get_account_info,
+        args=(base_config,),
+        setup=plugin._reset,
+        rounds=50
+    )
+
+    assert info['document']['region'] == 'us-east-1'
+
+
+def test_get_account_info_warm(benchmark, server):
+    plugin.get_account_info(base_config)
+    info = benchmark(plugin.get_account_info, base_config)
+
+    assert info['document']['region'] == 'us-east-1'
+
+
+def test_get_metadata_uncached(benchmark, server):
+    """Identity fetch with a cached token and pooled connections"""
+    plugin._get_api_header()
+    metadata = benchmark(plugin._get_metadata)
+
+    assert metadata['signature'] == 'fake-signature'
@@ -0,0 +1,138 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+import pytest
+
+from csp_billing_adapter_amazon import plugin
+
+timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+
+def get_dimensions(count):
+    return {f'tier_{index}': index for index in range(count)}
+
+
+def assert_submitted(status):
+    assert all(
+        dim_status['status'] == 'submitted' for dim_status in status.values()
+    )
+
+
+@pytest.mark.parametrize('dimension_count', [1, 6, 25])
+@pytest.mark.parametrize('max_workers', [1, 6])
+def test_meter_usage(benchmark, make_config, dimension_count, max_workers):
+    config = make_config(metering_max_workers=max_workers)
+    dimensions = get_dimensions(dimension_count)
+
+    status = benchmark(
+        plugin.meter_billing,
+        config,
+        dimensions,
+        timestamp,
+        dry_run=False
+    )
+
+    assert_submitted(status)
+
+
+@pytest.mark.parametrize('dimension_count', [1, 6, 25, 100])
+def test_batch_meter_usage(benchmark, make_config, dimension_count):
+    config = make_config(metering_max_workers=4)
+    dimensions = get_dimensions(dimension_count)
+
+    status = benchmark(
+        plugin.meter_billing,
+        config,
+        dimensions,
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+
+    assert_submitted(status)
+
+
+@pytest.mark.parametrize('customer_count', [1, 10, 100])
+def test_meter_billing_customers(benchmark, make_config, customer_count):
+    config = make_config(metering_max_workers=4)
+    usage = {
+        f'customer_{index}': get_dimensions(6)
+        for index in range(customer_count)
+    }
+
+    status = benchmark(
+        plugin.meter_billing_customers,
+        config,
+        usage,
+        timestamp
+    )
+
+    for customer_status in status.values():
+        assert_submitted(customer_status)
+
+
+@pytest.mark.parametrize('mode', ['single', 'batch'])
+def test_meter_billing_cold(benchmark, make_config, mode):
+    """Metering including region lookup and client creation"""
+    config = make_config()
+    customer_id = '123xyz' if mode == 'batch' else None
+
+    status = benchmark.pedantic(
+        plugin.meter_billing,
+        args=(config, get_dimensions(6), timestamp, False, customer_id),
+        setup=plugin._reset,
+        rounds=10
+    )
+
+    assert_submitted(status)
+
+
+@pytest.mark.parametrize('throttle_rate', [0.1, 0.3])
+def test_meter_billing_throttled(
+    benchmark,
+    server,
+    make_config,
+    throttle_rate
+):
+    server.throttle_rate = throttle_rate
+    config = make_config(metering_retry_attempts=10)
+
+    status = benchmark(
+        plugin.meter_billing,
+        config,
+        get_dimensions(6),
+        timestamp,
+        dry_run=False
+    )
+
+    assert_submitted(status)
+
+
+def test_batch_meter_usage_unprocessed(benchmark, server, make_config):
+    server.unprocessed_rate = 0.2
+    config = make_config(metering_retry_attempts=10)
+
+    status = benchmark(
+        plugin.meter_billing,
+        config,
+        get_dimensions(25),
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+
+    assert_submitted(status)
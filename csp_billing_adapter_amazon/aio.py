@@ -0,0 +1,142 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Asyncio variants of the Amazon plugin functions.
+
+The blocking plugin functions are run in the event loop default
+executor so they can be awaited concurrently with other work
+without stalling the event loop.
+"""
+
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from datetime import datetime
+
+from csp_billing_adapter.config import Config
+from csp_billing_adapter_amazon import plugin
+
+
+async def _run(func, *args, **kwargs):
+    """Run the blocking function in the default executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        functools.partial(func, *args, **kwargs)
+    )
+
+
+async def meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool,
+    customer_id: str = None
+):
+    """Process a metered billing based on the dimensions provided"""
+    return await _run(
+        plugin.meter_billing,
+        config,
+        dimensions,
+        timestamp,
+        dry_run,
+        customer_id=customer_id
+    )
+
+
+async def meter_billing_customers(
+    config: Config,
+    usage: dict,
+    timestamp: datetime
+):
+    """Process a metered billing for many customers at once"""
+    return await _run(
+        plugin.meter_billing_customers,
+        config,
+        usage,
+        timestamp
+    )
+
+
+async def _iterate(results):
+    """
+    Yield the items of the blocking generator
+
+    The generator is advanced in a dedicated thread, always the same
+    one so the trace context of the metering spans is kept. It is
+    closed if the consumer stops early.
+    """
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            while True:
+                result = await loop.run_in_executor(
+                    executor,
+                    next,
+                    results,
+                    None
+                )
+
+                if result is None:
+                    break
+
+                yield result
+        finally:
+            await loop.run_in_executor(executor, results.close)
+
+
+def iter_meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool,
+    customer_id: str = None
+):
+    """Return an async iterator of the result of each dimension"""
+    return _iterate(
+        plugin.iter_meter_billing(
+            config,
+            dimensions,
+            timestamp,
+            dry_run,
+            customer_id
+        )
+    )
+
+
+def iter_meter_billing_customers(
+    config: Config,
+    usage: dict,
+    timestamp: datetime
+):
+    """Return an async iterator of the result of each record"""
+    return _iterate(
+        plugin.iter_meter_billing_customers(config, usage, timestamp)
+    )
+
+
+async def get_account_info(config: Config):
+    """Return a dictionary with account information"""
+    return await _run(plugin.get_account_info, config)
+
+
+async def get_region(config: Config = None):
+    """Return the region name"""
+    return await _run(plugin.get_region, config)
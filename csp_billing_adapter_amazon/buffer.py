@@ -0,0 +1,163 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements an hourly aggregation buffer for usage records.
+
+AWS Marketplace meters usage per hour. The buffer sums the quantities
+reported for the same customer, dimension and hour so each of them can
+be submitted once, after the hour has ended.
+"""
+
+import json
+import os
+import threading
+
+from datetime import datetime, timezone
+
+
+class UsageBuffer:
+    """
+    Usage quantities summed per customer, dimension and hour
+
+    Each entry keeps the sum of the quantities and the latest
+    timestamp reported for the hour. If a path is given the entries
+    are saved to it as JSON on every change and loaded from it when
+    the buffer is created.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def add(self, usage: dict, timestamp: datetime):
+        """
+        Add the usage of each customer to the buffer
+
+        The usage is a mapping of customer_id, which may be None, to
+        a dictionary of the dimensions and quantities.
+        """
+        with self.lock:
+            for customer_id, dimensions in usage.items():
+                for dimension, quantity in dimensions.items():
+                    self._add(customer_id, dimension, quantity, timestamp)
+
+            self._save()
+
+    def restore(self, entries: list):
+        """Add entries returned by pop back to the buffer"""
+        with self.lock:
+            for entry in entries:
+                self._add(
+                    entry['customer_id'],
+                    entry['dimension'],
+                    entry['quantity'],
+                    entry['timestamp']
+                )
+
+            self._save()
+
+    def pop(self, before: datetime = None):
+        """
+        Remove and return the entries of the hours before the timestamp
+
+        All entries are returned if no timestamp is given. Each entry
+        is a dictionary of customer_id, dimension, hour, quantity and
+        timestamp.
+        """
+        hour = get_hour(before) if before else None
+
+        with self.lock:
+            keys = [
+                key for key in self.entries
+                if hour is None or key[2] < hour
+            ]
+            entries = [self.entries.pop(key) for key in keys]
+
+            if entries:
+                self._save()
+
+        return entries
+
+    def _add(
+        self,
+        customer_id: str,
+        dimension: str,
+        quantity: int,
+        timestamp: datetime
+    ):
+        key = (customer_id, dimension, get_hour(timestamp))
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.entries[key] = {
+                'customer_id': customer_id,
+                'dimension': dimension,
+                'hour': key[2],
+                'quantity': quantity,
+                'timestamp': timestamp
+            }
+            return
+
+        entry['quantity'] += quantity
+        entry['timestamp'] = max(entry['timestamp'], timestamp)
+
+    def _load(self):
+        with open(self.path) as buffer_file:
+            entries = json.load(buffer_file)
+
+        for entry in entries:
+            self._add(
+                entry['customer_id'],
+                entry['dimension'],
+                entry['quantity'],
+                datetime.fromisoformat(entry['timestamp'])
+            )
+
+    def _save(self):
+        if not self.path:
+            return
+
+        # Replace the file atomically so a crash never leaves it partial
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as buffer_file:
+            json.dump(
+                [
+                    dict(entry, timestamp=entry['timestamp'].isoformat())
+                    for entry in self.entries.values()
+                ],
+                buffer_file
+            )
+            buffer_file.flush()
+            os.fsync(buffer_file.fileno())
+
+        os.replace(temp_path, self.path)
+
+
+def get_hour(timestamp: datetime):
+    """Return the UTC hour of the timestamp"""
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc)
+
+    return timestamp.strftime('%Y-%m-%dT%H')
@@ -0,0 +1,120 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements a circuit breaker used to fail fast while the metering API
+or the instance metadata service is unavailable.
+"""
+
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a request while the circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a single endpoint
+
+    The circuit opens after failure_threshold consecutive failures.
+    While open, requests are rejected without being sent. After
+    reset_timeout seconds a single probe request is allowed in the
+    half-open state. The circuit closes if the probe succeeds and
+    opens again if it fails. A caller that is allowed to send the
+    probe but gives up before sending it must call release. A probe
+    without an outcome after reset_timeout seconds is given up and
+    another caller may send one.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        if failure_threshold < 1:
+            raise ValueError('Failure threshold must be at least 1')
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.probed = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return True if a request may be sent
+
+        In the half-open state only the first caller is allowed to
+        send the probe request.
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            now = time.monotonic()
+
+            if self.state == OPEN:
+                ready = now - self.opened >= self.reset_timeout
+            else:
+                # A probe without an outcome is given up after the timeout
+                ready = now - self.probed >= self.reset_timeout
+
+            if ready:
+                self.state = HALF_OPEN
+                self.probed = now
+
+            return ready
+
+    def release(self):
+        """
+        Give back the probe of a request that was not sent
+
+        The circuit returns to the open state and the next caller
+        is allowed to send the probe.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                # Keep the circuit ready for a probe right away
+                self.opened = self.probed - self.reset_timeout
+
+    def on_success(self):
+        """Close the circuit after a successful request"""
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def on_failure(self):
+        """
+        Record a failed request
+
+        Return True if the failure opened the circuit.
+        """
+        with self.lock:
+            self.failures += 1
+
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                opened = self.state != OPEN
+                self.state = OPEN
+                self.opened = time.monotonic()
+                return opened
+
+            return False
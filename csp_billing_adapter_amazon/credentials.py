@@ -0,0 +1,172 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements a shared credentials provider for the metering clients.
+
+Credentials are resolved with the botocore credential chain and cached.
+Temporary credentials, such as instance or task role credentials, are
+refreshed in a background thread ahead of their expiry so metering
+requests do not wait for STS or the metadata service.
+"""
+
+import logging
+import threading
+import time
+
+from datetime import datetime, timezone
+
+from botocore.credentials import (
+    CredentialProvider,
+    Credentials,
+    RefreshableCredentials
+)
+from botocore.session import Session
+
+from csp_billing_adapter_amazon.metrics import registry as metrics
+
+log = logging.getLogger('CSPBillingAdapter')
+
+# botocore refreshes credentials 15 minutes before they expire, the
+# cache is refreshed earlier so botocore always finds fresh credentials
+REFRESH_MARGIN = 1200
+RETRY_DELAY = 30
+
+
+class SharedCredentialsProvider(CredentialProvider):
+    """
+    Credential provider serving credentials from a shared cache
+
+    The first load resolves the credentials synchronously. If they
+    expire, a daemon thread resolves them again refresh_margin seconds
+    before the expiry, retrying every retry_delay seconds on failure.
+    Clients get refreshable credentials which read the cache, so a
+    refresh never blocks a request.
+    """
+
+    METHOD = 'shared-cache'
+    CANONICAL_NAME = 'SharedCache'
+
+    def __init__(
+        self,
+        profile: str = None,
+        refresh_margin: float = REFRESH_MARGIN,
+        retry_delay: float = RETRY_DELAY
+    ):
+        super().__init__()
+        self.profile = profile
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self.metadata = None
+        self.expiry = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def create_session(self):
+        """Return a botocore session using the provider"""
+        session = Session(profile=self.profile)
+        resolver = session.get_component('credential_provider')
+        resolver.insert_before('env', self)
+        return session
+
+    def load(self):
+        """Return the cached credentials, the botocore provider interface"""
+        metadata = self.get_metadata()
+
+        if metadata['expiry_time'] is None:
+            return Credentials(
+                metadata['access_key'],
+                metadata['secret_key'],
+                metadata['token'],
+                method=self.METHOD
+            )
+
+        return RefreshableCredentials.create_from_metadata(
+            metadata,
+            refresh_using=self.get_metadata,
+            method=self.METHOD
+        )
+
+    def get_metadata(self):
+        """Return the cached credentials, resolving them on first use"""
+        if self.metadata is None:
+            with self.lock:
+                if self.metadata is None:
+                    self.refresh()
+
+        return dict(self.metadata)
+
+    def refresh(self):
+        """Resolve the credentials with the botocore credential chain"""
+        start = time.perf_counter()
+
+        try:
+            credentials = Session(profile=self.profile).get_credentials()
+
+            if credentials is None:
+                raise Exception('Unable to locate credentials')
+
+            frozen = credentials.get_frozen_credentials()
+        except Exception:
+            metrics.inc('credentials_refresh_failures_total')
+            raise
+        finally:
+            metrics.observe(
+                'credentials_refresh_seconds',
+                time.perf_counter() - start
+            )
+
+        # botocore does not expose the expiry of refreshable credentials
+        self.expiry = getattr(credentials, '_expiry_time', None)
+        self.metadata = {
+            'access_key': frozen.access_key,
+            'secret_key': frozen.secret_key,
+            'token': frozen.token,
+            'expiry_time': self.expiry.isoformat() if self.expiry else None
+        }
+
+        if self.expiry and self.thread is None and not self.stopped:
+            self.thread = threading.Thread(
+                target=self._run,
+                name='credentials-refresh',
+                daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """Stop refreshing the credentials"""
+        self.stopped = True
+        self.wakeup.set()
+
+    def _get_refresh_delay(self):
+        remaining = (
+            self.expiry - datetime.now(timezone.utc)
+        ).total_seconds()
+        return max(0, remaining - self.refresh_margin)
+
+    def _run(self):
+        delay = self._get_refresh_delay()
+
+        while not self.wakeup.wait(delay):
+            try:
+                self.refresh()
+            except Exception as error:
+                log.warning(f'Unable to refresh credentials: {str(error)}')
+                delay = self.retry_delay
+            else:
+                delay = max(self.retry_delay, self._get_refresh_delay())
@@ -0,0 +1,305 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements a local stand-in for the instance metadata service and the
+AWS Marketplace metering API.
+
+The server answers IMDSv2 token and instance identity requests and
+MeterUsage and BatchMeterUsage requests sent to the metering client
+endpoint_url. Latency, errors, throttling and unprocessed batch records
+can be injected to exercise the plugin without AWS access.
+
+The server can be run standalone:
+
+    python -m csp_billing_adapter_amazon.fake_server --port 8080
+
+and used by the plugin with:
+
+    AWS_EC2_METADATA_SERVICE_ENDPOINT=http://127.0.0.1:8080/
+
+and the metering_endpoint_url config option set to the same URL.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_PATH = '/latest/api/token'
+IDENTITY_PATH = '/latest/dynamic/instance-identity/'
+METERING_TARGET = 'AWSMPMeteringService.'
+
+
+class FakeAWSServer:
+    """
+    Fake instance metadata and metering endpoints
+
+    :param host: The address to listen on
+    :param port: The port to listen on, 0 picks a free port
+    :param region: The region in the instance identity document
+    :param latency: Seconds added to each metering response
+    :param imds_latency: Seconds added to each metadata response
+    :param error_rate: Fraction of metering requests failing with
+        an InternalServiceErrorException
+    :param throttle_rate: Fraction of metering requests failing with
+        a ThrottlingException
+    :param unprocessed_rate: Fraction of batch records returned as
+        UnprocessedRecords
+    :param seed: Seed of the random generator for reproducible runs
+    """
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        region: str = 'us-east-1',
+        latency: float = 0,
+        imds_latency: float = 0,
+        error_rate: float = 0,
+        throttle_rate: float = 0,
+        unprocessed_rate: float = 0,
+        seed: int = None
+    ):
+        self.region = region
+        self.latency = latency
+        self.imds_latency = imds_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.unprocessed_rate = unprocessed_rate
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+
+    @property
+    def url(self):
+        """Return the base URL of the server"""
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def document(self):
+        """Return the instance identity document"""
+        return {
+            'accountId': '123456789012',
+            'architecture': 'x86_64',
+            'availabilityZone': f'{self.region}a',
+            'imageId': 'ami-1234567890abcdefg',
+            'instanceId': 'i-1234567890abcdefg',
+            'instanceType': 't3.micro',
+            'region': self.region,
+            'version': '2017-09-30'
+        }
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            name='fake-aws-server',
+            daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving requests and close the socket"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, name: str):
+        """Increment the request counter for the name"""
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def chance(self, rate: float):
+        """Return True with the probability of the rate"""
+        if not rate:
+            return False
+
+        with self.lock:
+            return self.random.random() < rate
+
+    def issue_token(self):
+        """Return a new metadata token"""
+        token = uuid.uuid4().hex
+
+        with self.lock:
+            self.tokens.add(token)
+
+        return token
+
+    def is_valid_token(self, token: str):
+        """Return True if the token was issued by the server"""
+        with self.lock:
+            return token in self.tokens
+
+    def revoke_tokens(self):
+        """Invalidate all issued metadata tokens"""
+        with self.lock:
+            self.tokens.clear()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _send(self, status: int, body: bytes, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: dict):
+        self._send(
+            status,
+            json.dumps(data).encode(),
+            'application/x-amz-json-1.1'
+        )
+
+    def _send_error(self, status: int, code: str, message: str):
+        self.fake.count(code)
+        self._send_json(status, {'__type': code, 'message': message})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def do_PUT(self):
+        self._read_body()
+        self.fake.count('token')
+        time.sleep(self.fake.imds_latency)
+
+        if self.path != TOKEN_PATH:
+            self._send(404, b'Not Found')
+        elif not self.headers.get('X-aws-ec2-metadata-token-ttl-seconds'):
+            self._send(400, b'Bad Request')
+        else:
+            self._send(200, self.fake.issue_token().encode())
+
+    def do_GET(self):
+        self.fake.count('metadata')
+        time.sleep(self.fake.imds_latency)
+
+        token = self.headers.get('X-aws-ec2-metadata-token')
+        resource = self.path[len(IDENTITY_PATH):]
+
+        if not self.path.startswith(IDENTITY_PATH):
+            self._send(404, b'Not Found')
+        elif not self.fake.is_valid_token(token):
+            self._send(401, b'Unauthorized')
+        elif resource == 'document':
+            self._send(200, json.dumps(self.fake.document).encode())
+        elif resource in ('signature', 'pkcs7'):
+            self._send(200, f'fake-{resource}'.encode())
+        else:
+            self._send(404, b'Not Found')
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b'{}')
+        target = self.headers.get('X-Amz-Target', '')
+        operation = target[len(METERING_TARGET):]
+        time.sleep(self.fake.latency)
+
+        if operation not in ('MeterUsage', 'BatchMeterUsage'):
+            self._send_error(400, 'UnknownOperationException', target)
+        elif self.fake.chance(self.fake.throttle_rate):
+            self._send_error(400, 'ThrottlingException', 'Rate exceeded')
+        elif self.fake.chance(self.fake.error_rate):
+            self._send_error(
+                500,
+                'InternalServiceErrorException',
+                'Internal service error'
+            )
+        elif operation == 'MeterUsage':
+            self.fake.count(operation)
+            self._send_json(200, {'MeteringRecordId': str(uuid.uuid4())})
+        else:
+            self.fake.count(operation)
+            self._send_json(200, self._batch_meter_usage(body))
+
+    def _batch_meter_usage(self, body: dict):
+        results = []
+        unprocessed = []
+
+        for record in body.get('UsageRecords', []):
+            if self.fake.chance(self.fake.unprocessed_rate):
+                unprocessed.append(record)
+            else:
+                results.append({
+                    'UsageRecord': record,
+                    'MeteringRecordId': str(uuid.uuid4()),
+                    'Status': 'Success'
+                })
+
+        return {'Results': results, 'UnprocessedRecords': unprocessed}
+
+
+def main(args=None):
+    """Run the fake server until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--imds-latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--unprocessed-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int)
+    options = parser.parse_args(args)
+
+    server = FakeAWSServer(**vars(options))
+    print(f'Serving on {server.url}')
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,189 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements a durable write-ahead journal for metering records.
+
+Each usage record is written to a SQLite database before it is
+submitted and marked acknowledged with its metering record id once
+the submission succeeds. Records that are not acknowledged can be
+resubmitted later, including after a restart. Records rejected with
+a permanent error are kept but never resubmitted.
+"""
+
+import sqlite3
+import threading
+import time
+
+from datetime import datetime
+
+PENDING = 'pending'
+QUEUED = 'queued'
+FAILED = 'failed'
+REJECTED = 'rejected'
+ACKNOWLEDGED = 'acknowledged'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    customer_id TEXT,
+    dimension TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    state TEXT NOT NULL,
+    record_id TEXT,
+    error_code TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_state ON records (state, created);
+'''
+
+
+class MeteringJournal:
+    """
+    SQLite backed journal of metering records
+
+    Records are appended as pending before submission, or queued
+    when submission is left to the drainer. Records written as
+    pending by a previous process that never completed are treated
+    as unsubmitted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.opened = time.time()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.executescript(SCHEMA)
+
+    def append(self, records: list, state: str = PENDING):
+        """
+        Append usage records to the journal
+
+        Each record is a tuple of customer_id, which may be None,
+        dimension, quantity and timestamp. Return the entry ids in
+        the same order.
+        """
+        now = time.time()
+        entry_ids = []
+
+        with self.lock, self.connection:
+            for customer_id, dimension, quantity, timestamp in records:
+                cursor = self.connection.execute(
+                    'INSERT INTO records (customer_id, dimension, quantity, '
+                    'timestamp, state, created, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        customer_id,
+                        dimension,
+                        quantity,
+                        timestamp.isoformat(),
+                        state,
+                        now,
+                        now
+                    )
+                )
+                entry_ids.append(cursor.lastrowid)
+
+        return entry_ids
+
+    def acknowledge(self, entry_id: int, record_id: str):
+        """Mark the entry submitted with the metering record id"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE records SET state = ?, record_id = ?, updated = ? '
+                'WHERE id = ?',
+                (ACKNOWLEDGED, record_id, time.time(), entry_id)
+            )
+
+    def fail(self, entry_id: int, error_code: str = None):
+        """Mark the entry as failed so it is resubmitted"""
+        self._set_failed(entry_id, FAILED, error_code)
+
+    def reject(self, entry_id: int, error_code: str = None):
+        """Mark the entry as failed with a permanent error"""
+        self._set_failed(entry_id, REJECTED, error_code)
+
+    def _set_failed(self, entry_id: int, state: str, error_code: str):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE records SET state = ?, error_code = ?, '
+                'attempts = attempts + 1, updated = ? WHERE id = ?',
+                (state, error_code, time.time(), entry_id)
+            )
+
+    def get_unsubmitted(self, max_attempts: int = 10, limit: int = 1000):
+        """
+        Return the entries waiting to be submitted
+
+        These are queued entries, failed entries with fewer than
+        max_attempts attempts, and pending entries left behind by a
+        previous process. Each entry is a dictionary with the entry
+        id, customer_id, dimension, quantity, timestamp and the error
+        code of the last failure.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, customer_id, dimension, quantity, timestamp, '
+                'error_code FROM records WHERE state = ? '
+                'OR (state = ? AND attempts < ?) '
+                'OR (state = ? AND created < ?) '
+                'ORDER BY id LIMIT ?',
+                (
+                    QUEUED,
+                    FAILED,
+                    max_attempts,
+                    PENDING,
+                    self.opened,
+                    limit
+                )
+            ).fetchall()
+
+        return [
+            {
+                'id': entry_id,
+                'customer_id': customer_id,
+                'dimension': dimension,
+                'quantity': quantity,
+                'timestamp': datetime.fromisoformat(timestamp),
+                'error_code': error_code
+            }
+            for (
+                entry_id,
+                customer_id,
+                dimension,
+                quantity,
+                timestamp,
+                error_code
+            ) in rows
+        ]
+
+    def prune(self, retention: float):
+        """Delete acknowledged and rejected entries older than retention"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM records WHERE state IN (?, ?) AND updated < ?',
+                (ACKNOWLEDGED, REJECTED, time.time() - retention)
+            )
+
+    def close(self):
+        """Close the journal database"""
+        with self.lock:
+            self.connection.close()
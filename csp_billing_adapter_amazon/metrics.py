@@ -0,0 +1,278 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements lightweight counters and latency histograms for the plugin.
+
+Metrics are kept in memory in the shared registry. They can be read
+with render, which returns the Prometheus text exposition format,
+served over HTTP with serve, or forwarded to another metrics system
+by registering a callback with add_callback.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger('CSPBillingAdapter')
+
+PREFIX = 'csp_billing_adapter_amazon_'
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+
+class Metrics:
+    """
+    Thread safe registry of counters and histograms
+
+    Metrics are identified by name and an optional set of labels.
+    Histograms count observations in cumulative buckets of the given
+    upper bounds, in seconds.
+
+    Callbacks are called with the metric type, name, value and labels
+    of each update. Errors raised by a callback are logged and ignored
+    so metrics never interfere with metering.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counters = {}
+        self.histograms = {}
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment the counter by value"""
+        key = (name, _get_labels(labels))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        self._notify(COUNTER, name, value, labels)
+
+    def observe(self, name: str, value: float, **labels):
+        """Add an observation to the histogram"""
+        key = (name, _get_labels(labels))
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = {
+                    'buckets': [0] * len(self.buckets),
+                    'count': 0,
+                    'sum': 0
+                }
+                self.histograms[key] = histogram
+
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+        self._notify(HISTOGRAM, name, value, labels)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the duration of the block in the histogram"""
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get_counter(self, name: str, **labels):
+        """Return the value of the counter"""
+        with self.lock:
+            return self.counters.get((name, _get_labels(labels)), 0)
+
+    def get_histogram(self, name: str, **labels):
+        """
+        Return the count, sum and cumulative bucket counts
+
+        Buckets are keyed by their upper bound. Return None if
+        nothing was observed.
+        """
+        with self.lock:
+            histogram = self.histograms.get((name, _get_labels(labels)))
+
+            if histogram is None:
+                return None
+
+            buckets = {}
+            total = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                total += count
+                buckets[bound] = total
+
+            return {
+                'buckets': buckets,
+                'count': histogram['count'],
+                'sum': histogram['sum']
+            }
+
+    def add_callback(self, callback):
+        """Call the callback on every metric update"""
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Stop calling the callback on metric updates"""
+        with self.lock:
+            self.callbacks.remove(callback)
+
+    def _notify(self, metric_type: str, name: str, value: float, labels):
+        for callback in list(self.callbacks):
+            try:
+                callback(metric_type, name, value, labels)
+            except Exception as error:
+                log.warning(f'Metrics callback failed: {str(error)}')
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, dict(value, buckets=list(value['buckets'])))
+                for key, value in self.histograms.items()
+            )
+
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f'# TYPE {PREFIX}{name} counter')
+                declared.add(name)
+
+            lines.append(
+                f'{PREFIX}{name}{_format_labels(labels)} {_format(value)}'
+            )
+
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                declared.add(name)
+
+            total = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                total += count
+                bucket_labels = labels + (('le', _format(bound)),)
+                lines.append(
+                    f'{PREFIX}{name}_bucket{_format_labels(bucket_labels)} '
+                    f'{total}'
+                )
+
+            bucket_labels = labels + (('le', '+Inf'),)
+            lines.append(
+                f'{PREFIX}{name}_bucket{_format_labels(bucket_labels)} '
+                f'{histogram["count"]}'
+            )
+            lines.append(
+                f'{PREFIX}{name}_sum{_format_labels(labels)} '
+                f'{_format(histogram["sum"])}'
+            )
+            lines.append(
+                f'{PREFIX}{name}_count{_format_labels(labels)} '
+                f'{histogram["count"]}'
+            )
+
+        return ''.join(f'{line}\n' for line in lines)
+
+    def reset(self):
+        """Drop all recorded values"""
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """
+        Serve the metrics at /metrics in a background thread
+
+        Return the HTTP server, call shutdown on it to stop serving.
+        """
+        httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+        httpd.daemon_threads = True
+        httpd.metrics = self
+
+        thread = threading.Thread(
+            target=httpd.serve_forever,
+            name='metrics-server',
+            daemon=True
+        )
+        thread.start()
+
+        log.info(f'Serving metrics on {host}:{httpd.server_address[1]}')
+        return httpd
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _get_labels(labels: dict):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: tuple):
+    if not labels:
+        return ''
+
+    formatted = ','.join(
+        '{0}="{1}"'.format(
+            key,
+            value.replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n',
+                '\\n'
+            )
+        )
+        for key, value in labels
+    )
+    return '{' + formatted + '}'
+
+
+def _format(value: float):
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+# Shared registry used by the plugin
+registry = Metrics()
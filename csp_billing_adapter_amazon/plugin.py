@@ -19,28 +19,229 @@ Implements the CSP hook functions for Amazon AWS. This handles the
 metered billing of product usage in the AWS Marketplace.
 """
 
-import boto3
+import atexit
 import json
 import logging
+import os
+import random
+import threading
+import socket
 import time
-import urllib.request
-import urllib.error
 
 import csp_billing_adapter
 
-from datetime import datetime
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    TimeoutError as FuturesTimeoutError,
+    wait
+)
+from contextvars import copy_context
+from itertools import chain
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from http.client import HTTPConnection, HTTPException
 from socket import (has_ipv6, create_connection)
+from urllib.parse import urlsplit
 
 from csp_billing_adapter.config import Config
 from csp_billing_adapter_amazon import __version__
+from csp_billing_adapter_amazon.buffer import UsageBuffer
+from csp_billing_adapter_amazon.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError
+)
+from csp_billing_adapter_amazon.journal import (
+    MeteringJournal,
+    PENDING,
+    QUEUED
+)
+from csp_billing_adapter_amazon.metrics import registry as metrics
+from csp_billing_adapter_amazon.rate_limiter import RateLimiter
+from csp_billing_adapter_amazon.results import MeteringResult
+from csp_billing_adapter_amazon.tracing import span
 
 log = logging.getLogger('CSPBillingAdapter')
 
+METERING_SERVICE = 'meteringmarketplace'
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+BATCH_METERING_LIMIT = 25
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+THROTTLING_ERRORS = (
+    'ThrottlingException',
+    'Throttling',
+    'TooManyRequestsException'
+)
+NON_RETRYABLE_ERRORS = (
+    'CustomerNotEntitledException',
+    'DisabledApiException',
+    'DuplicateRequestException',
+    'InvalidCustomerIdentifierException',
+    'InvalidEndpointRegionException',
+    'InvalidProductCodeException',
+    'InvalidTagException',
+    'InvalidUsageAllocationsException',
+    'InvalidUsageDimensionException',
+    'TimestampOutOfBoundsException',
+    'AccessDeniedException',
+    'ValidationException',
+    # Status of a BatchMeterUsage result
+    'CustomerNotSubscribed'
+)
+EXPIRED_CREDENTIALS_ERRORS = (
+    'ExpiredToken',
+    'ExpiredTokenException',
+    'RequestExpired',
+    'InvalidClientTokenId',
+    'UnrecognizedClientException'
+)
+SERVICE_ERRORS = (
+    'InternalServiceErrorException',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'ServiceUnavailableException'
+)
+BREAKER_THRESHOLD = 5
+BREAKER_TIMEOUT = 30
+DEDUP_INDEX_SIZE = 10000
+JOURNAL_DRAIN_INTERVAL = 300
+JOURNAL_MAX_ATTEMPTS = 10
+JOURNAL_RETENTION = 7 * 24 * 3600
+BUFFER_FLUSH_DELAY = 60
+IMDS_IPV6_ADDR = 'fd00:ec2::254'
+IMDS_IPV4_ADDR = '169.254.169.254'
+IPV6_PREFERENCE_DELAY = 0.3
+IMDS_TOKEN_TTL = 21600
+IMDS_TOKEN_REFRESH_MARGIN = 300
+IDENTITY_OPTIONS = ('document', 'signature', 'pkcs7')
+IMDS_CONNECTION_ERRORS = (OSError, HTTPException)
+ECS_METADATA_TIMEOUT = 1
+REGION_RESOLVERS = ('config', 'environment', 'ecs', 'imds')
+IDENTITY_RESOLVERS = ('imds', 'ecs')
+
+# Metering clients shared by all threads, keyed by region and profile
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Metering rate limiters shared by all threads, keyed by region
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+# Metering circuit breakers shared by all threads, keyed by region
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# Acknowledged metering record ids keyed by product code, customer,
+# dimension and hour
+_dedup_index = OrderedDict()
+_dedup_lock = threading.Lock()
+
+# Metering journal and the event waking up its drainer
+_journal = None
+_journal_lock = threading.Lock()
+_journal_wakeup = threading.Event()
+
+# Hourly usage buffer and the event waking up its flusher
+_buffer = None
+_buffer_lock = threading.Lock()
+_buffer_wakeup = threading.Event()
+
+# Memoized instance metadata endpoint address
+_imds_ip_addr = None
+_imds_ip_addr_lock = threading.Lock()
+
+# Idle keep-alive metadata connections keyed by endpoint address
+_imds_connections = {}
+_imds_connections_lock = threading.Lock()
+_imds_settings = {
+    'connect_timeout': 1,
+    'read_timeout': 2,
+    'max_connections': 4,
+    'metadata_timeout': 5,
+    'breaker_threshold': 3,
+    'breaker_timeout': 30
+}
+_imds_breaker = None
+_imds_breaker_lock = threading.Lock()
+
+# Cached IMDSv2 token and its expiry in monotonic time
+_imds_token = None
+_imds_token_expires = 0
+_imds_token_lock = threading.Lock()
+
+# ECS task metadata, immutable for the life of the task
+_ecs_task_metadata = {}
+_ecs_task_metadata_lock = threading.Lock()
+
+# Instance identity document, signature and pkcs7
+_identity = {}
+_identity_lock = threading.Lock()
+
+# boto3 and botocore are imported on first use, see _load_boto3
+boto3 = None
+BotoConfig = None
+SharedCredentialsProvider = None
+_boto3_lock = threading.Lock()
+
+# boto3 sessions and their credentials providers, keyed by profile
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Metrics exposition server started from the metrics_port option
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
 
 @csp_billing_adapter.hookimpl
 def setup_adapter(config: Config):
-    """Handle any plugin specific setup at adapter start"""
-    pass
+    """
+    Handle any plugin specific setup at adapter start
+
+    Populate the instance identity cache so region and account
+    info are served from memory once the adapter is running. If
+    identity_cache_file is configured the identity is saved to it,
+    and loaded from it when the metadata service is unavailable.
+
+    If metrics_port is configured the metrics are served in the
+    Prometheus text format on that port.
+
+    If metering_prewarm is enabled boto3 is imported and the metering
+    client created in a background thread, so the first metering call
+    does not pay for it.
+    """
+    cache_file = config.get('identity_cache_file')
+    _configure_imds(config)
+    _start_metrics_server(config)
+
+    try:
+        identity = _get_identity()
+    except Exception as error:
+        log.warning(f'Unable to retrieve instance identity: {str(error)}')
+        identity = {}
+
+    if cache_file:
+        if _is_complete_identity(identity):
+            _save_identity(cache_file, identity)
+        else:
+            _load_identity(cache_file)
+
+    if config.get('metering_prewarm'):
+        threading.Thread(
+            target=_prewarm_client,
+            args=(config,),
+            name='metering-prewarm',
+            daemon=True
+        ).start()
+
+
+def _prewarm_client(config: Config):
+    """Create the metering client for the instance region"""
+    try:
+        _get_client(config, get_region(config))
+    except Exception as error:
+        log.warning(f'Unable to prewarm metering client: {str(error)}')
 
 
 def meter_usage(
@@ -49,46 +250,227 @@ def meter_usage(
     region: str,
     timestamp: datetime,
     dimensions: dict,
-    dry_run: str
+    dry_run: str,
+    deadline: float = None
 ):
-    for dimension_name, usage_quantity in dimensions.items():
-        retries = 3
-        while retries > 0:
-            try:
-                client = boto3.client(
-                    'meteringmarketplace',
-                    region_name=region
+    """
+    Meter each dimension with the MeterUsage API
+
+    If metering_max_workers is greater than 1 the dimensions are
+    metered concurrently using up to that many threads. No attempt
+    is started after the deadline, in monotonic time, if provided.
+    """
+    results = _iter_meter_usage(
+        config,
+        region,
+        timestamp,
+        dimensions,
+        dry_run,
+        deadline
+    )
+    status.update(_get_status({None: dimensions}, results).get(None, {}))
+
+
+def _iter_meter_usage(
+    config: Config,
+    region: str,
+    timestamp: datetime,
+    dimensions: dict,
+    dry_run: str,
+    deadline: float = None,
+    on_result=None
+):
+    """
+    Yield the result of each dimension as its metering completes
+
+    If provided, on_result is called with each result as in
+    _iter_concurrently.
+    """
+    with metrics.timer('meter_usage_seconds'):
+        yield from _iter_concurrently(
+            config,
+            _meter_dimension,
+            [
+                (
+                    config,
+                    region,
+                    timestamp,
+                    dimension_name,
+                    usage_quantity,
+                    dry_run,
+                    deadline
+                )
+                for dimension_name, usage_quantity in dimensions.items()
+            ],
+            on_result
+        )
+
+
+def _iter_concurrently(
+    config: Config,
+    func,
+    tasks: list,
+    on_result=None
+):
+    """
+    Call the function with each tuple of arguments and yield the results
+
+    If metering_max_workers is greater than 1 up to that many calls run
+    concurrently in threads and the results are yielded in completion
+    order. Further calls are only started as results are yielded so
+    no more than that many results are held at once. Otherwise the
+    calls run one at a time in the calling thread.
+
+    If provided, on_result is called with each result as soon as the
+    call returns and the result it returns is yielded instead. When
+    the generator is closed early the calls in progress still
+    complete and on_result is called with their results, although
+    they are not yielded.
+    """
+    max_workers = min(config.get('metering_max_workers', 1), len(tasks))
+
+    if max_workers <= 1:
+        for args in tasks:
+            yield _call_reporting(on_result, func, *args)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for args in tasks:
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+            # Keep the trace context in the worker threads
+            pending.add(executor.submit(
+                copy_context().run,
+                _call_reporting,
+                on_result,
+                func,
+                *args
+            ))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                yield future.result()
+
+
+def _call_reporting(on_result, func, *args):
+    """Return the result of the function as reported by on_result"""
+    result = func(*args)
+
+    if on_result:
+        result = on_result(result)
+
+    return result
+
+
+def _meter_dimension(
+    config: Config,
+    region: str,
+    timestamp: datetime,
+    dimension_name: str,
+    usage_quantity: int,
+    dry_run: str,
+    deadline: float = None
+):
+    """
+    Meter a single dimension and return its result
+
+    If metering_dedup is enabled a dimension already acknowledged
+    for the same hour is not submitted again, and a duplicate
+    request error is treated as success.
+    """
+    start = time.perf_counter()
+    dedup_key = None
+    if config.get('metering_dedup') and not dry_run:
+        dedup_key = _get_dedup_key(config, None, dimension_name, timestamp)
+        result = _get_acknowledged(dedup_key)
+
+        if result:
+            return result
+
+    exc = Exception('Metering deadline exceeded')
+    attempt = 0
+    while _wait_before_attempt(config, attempt, deadline):
+        if attempt:
+            metrics.inc('metering_retries_total', dimension=dimension_name)
+
+        attempt += 1
+
+        try:
+            response = _call_metering(
+                config,
+                region,
+                'meter_usage',
+                deadline,
+                ProductCode=config.product_code,
+                Timestamp=timestamp,
+                UsageDimension=dimension_name,
+                UsageQuantity=usage_quantity,
+                DryRun=dry_run
+            )
+        except Exception as error:
+            if dedup_key and \
+                    _get_error_code(error) == 'DuplicateRequestException':
+                log.info(
+                    f'Dimension {dimension_name} already metered '
+                    'for this hour'
                 )
-                response = client.meter_usage(
-                    ProductCode=config.product_code,
-                    Timestamp=timestamp,
-                    UsageDimension=dimension_name,
-                    UsageQuantity=usage_quantity,
-                    DryRun=dry_run
+                _set_acknowledged(dedup_key, None)
+                return MeteringResult(
+                    None,
+                    dimension_name,
+                    'submitted',
+                    latency=time.perf_counter() - start
                 )
-            except Exception as error:
-                exc = error
-                retries -= 1
-                continue
-            else:
-                record_id = response.get('MeteringRecordId', None)
-                log.info(f'New metered billing record with ID: {record_id}')
-                status[dimension_name] = {
-                    'record_id': record_id,
-                    'status': 'submitted'
-                }
-                exc = None
+
+            exc = error
+            _handle_client_error(error, config, region)
+
+            if _get_error_code(error) in THROTTLING_ERRORS:
+                metrics.inc(
+                    'metering_throttles_total',
+                    dimension=dimension_name
+                )
+
+            if not _is_retryable_error(config, error):
                 break
 
-        if exc:
-            msg = (
-                f'Failed to meter bill dimension {dimension_name}: {str(exc)}'
+            continue
+        else:
+            metrics.inc('metering_records_total', dimension=dimension_name)
+            record_id = response.get('MeteringRecordId', None)
+            log.info(f'New metered billing record with ID: {record_id}')
+
+            if dedup_key:
+                _set_acknowledged(dedup_key, record_id)
+
+            return MeteringResult(
+                None,
+                dimension_name,
+                'submitted',
+                record_id,
+                latency=time.perf_counter() - start
             )
-            status[dimension_name] = {
-                'error': msg,
-                'status': 'failed'
-            }
-            log.error(msg)
+
+    msg = (
+        f'Failed to meter bill dimension {dimension_name}: {str(exc)}'
+    )
+    log.error(msg)
+    metrics.inc('metering_failures_total', dimension=dimension_name)
+    return MeteringResult(
+        None,
+        dimension_name,
+        'failed',
+        error=msg,
+        error_code=_get_error_code(exc),
+        latency=time.perf_counter() - start
+    )
 
 
 def batch_meter_usage(
@@ -97,73 +479,277 @@ def batch_meter_usage(
     region: str,
     timestamp: datetime,
     dimensions: dict,
-    customer_id: str
+    customer_id: str,
+    deadline: float = None
+):
+    """
+    Meter the dimensions for a customer with the BatchMeterUsage API
+
+    The records are split into batches of at most 25 records, the
+    limit of the API. If metering_max_workers is greater than 1 the
+    batches are submitted concurrently. No attempt is started after
+    the deadline, in monotonic time, if provided.
+    """
+    usage = {customer_id: dimensions}
+    results = _iter_batch_meter_usage(
+        config,
+        region,
+        timestamp,
+        usage,
+        deadline
+    )
+    status.update(_get_status(usage, results).get(customer_id, {}))
+
+
+def _iter_batch_meter_usage(
+    config: Config,
+    region: str,
+    timestamp: datetime,
+    usage: dict,
+    deadline: float = None,
+    on_result=None
 ):
+    """
+    Yield the result of each record as its batch completes
+
+    If provided, on_result is called with each result as in
+    _iter_concurrently.
+    """
+    records = _get_usage_records(timestamp, usage)
+
+    with metrics.timer('batch_meter_usage_seconds'):
+        yield from _iter_batch_meter_records(
+            config,
+            region,
+            records,
+            deadline,
+            on_result
+        )
+
+
+def _get_usage_records(timestamp: datetime, usage: dict):
+    """Return the usage records for a mapping of customer to dimensions"""
     records = []
-    for dimension_name, usage_quantity in dimensions.items():
-        records.append({
-            'Timstamp': timestamp,
-            'CustomerIdentifier': customer_id,
-            'Dimension': dimension_name,
-            'Quantity': usage_quantity
-        })
-
-    retries = 3
-    exc = None
-    while retries > 0:
-        try:
-            client = boto3.client(
-                'meteringmarketplace',
-                region_name=region
+    for customer_id, dimensions in usage.items():
+        for dimension_name, usage_quantity in dimensions.items():
+            records.append({
+                'Timestamp': timestamp,
+                'CustomerIdentifier': customer_id,
+                'Dimension': dimension_name,
+                'Quantity': usage_quantity
+            })
+
+    return records
+
+
+def _iter_batch_meter_records(
+    config: Config,
+    region: str,
+    records: list,
+    deadline: float = None,
+    on_result=None
+):
+    """
+    Submit the usage records in batches of the API limit
+
+    If metering_dedup is enabled records already acknowledged for
+    the same hour are not submitted again.
+
+    Yield the result of each record as its batch completes. If
+    provided, on_result is called with each result as in
+    _iter_concurrently.
+    """
+    dedup_keys = {}
+
+    def report(results):
+        reported = []
+        for result in results:
+            dedup_key = dedup_keys.get((result.customer_id, result.dimension))
+
+            if dedup_key and result.status == 'submitted':
+                _set_acknowledged(dedup_key, result.record_id)
+
+            reported.append(on_result(result) if on_result else result)
+
+        return reported
+
+    if config.get('metering_dedup'):
+        unacknowledged = []
+        for record in records:
+            key = (record['CustomerIdentifier'], record['Dimension'])
+            dedup_keys[key] = _get_dedup_key(
+                config,
+                key[0],
+                key[1],
+                record['Timestamp']
             )
-            response = client.batch_meter_usage(
-                UsageRecords=records,
+            result = _get_acknowledged(dedup_keys[key])
+
+            if result:
+                yield from report([result])
+            else:
+                unacknowledged.append(record)
+
+        records = unacknowledged
+
+    batches = [
+        (config, region, records[index:index + BATCH_METERING_LIMIT], deadline)
+        for index in range(0, len(records), BATCH_METERING_LIMIT)
+    ]
+
+    yield from chain.from_iterable(
+        _iter_concurrently(config, _submit_batch, batches, report)
+    )
+
+
+def _get_dedup_key(
+    config: Config,
+    customer_id: str,
+    dimension: str,
+    timestamp: datetime
+):
+    """
+    Return the deduplication key of a usage record
+
+    Marketplace accepts one record per customer and dimension per
+    hour, the key uses the hour of the timestamp in UTC.
+    """
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc)
+
+    return (
+        config.product_code,
+        customer_id,
+        dimension,
+        timestamp.strftime('%Y-%m-%dT%H')
+    )
+
+
+def _get_acknowledged(dedup_key: tuple):
+    """
+    Return the result of an already acknowledged record
+
+    Return None if the record was not acknowledged.
+    """
+    with _dedup_lock:
+        if dedup_key not in _dedup_index:
+            return None
+
+        _dedup_index.move_to_end(dedup_key)
+        record_id = _dedup_index[dedup_key]
+
+    log.info(f'Usage already acknowledged with ID: {record_id}')
+    return MeteringResult(dedup_key[1], dedup_key[2], 'submitted', record_id)
+
+
+def _set_acknowledged(dedup_key: tuple, record_id: str):
+    """
+    Record the acknowledged record id
+
+    The least recently used entries are evicted beyond
+    DEDUP_INDEX_SIZE entries.
+    """
+    with _dedup_lock:
+        _dedup_index[dedup_key] = record_id
+        _dedup_index.move_to_end(dedup_key)
+
+        while len(_dedup_index) > DEDUP_INDEX_SIZE:
+            _dedup_index.popitem(last=False)
+
+
+def _submit_batch(
+    config: Config,
+    region: str,
+    records: list,
+    deadline: float = None
+):
+    """
+    Submit a single batch with the BatchMeterUsage API
+
+    Unprocessed records and transient errors are retried with
+    exponential backoff, resubmitting only the records that were
+    not processed. Permanent errors are not retried.
+
+    Return the result of each record in the batch.
+    """
+    start = time.perf_counter()
+    results = []
+    pending = records
+    attempt = 0
+    exc = Exception('Metering deadline exceeded')
+    while pending and _wait_before_attempt(config, attempt, deadline):
+        if attempt:
+            _count_records('metering_retries_total', pending)
+
+        attempt += 1
+
+        try:
+            response = _call_metering(
+                config,
+                region,
+                'batch_meter_usage',
+                deadline,
+                UsageRecords=pending,
                 ProductCode=config.product_code
             )
         except Exception as error:
             exc = error
-            retries -= 1
+            _handle_client_error(error, config, region)
+
+            if _get_error_code(error) in THROTTLING_ERRORS:
+                _count_records('metering_throttles_total', pending)
+
+            if not _is_retryable_error(config, error):
+                break
+
             continue
-        else:
-            for record in response.get('Results', []):
-                dimension = record['UsageRecord']['Dimension']
-                record_id = record.get('MeteringRecordId', None)
-                dim_status = record.get('Status')
-
-                if not dim_status:
-                    msg = f'Status unknown for dimension: {dimension}'
-                    status[dimension] = {
-                        'error': msg,
-                        'status': 'failed'
-                    }
-                    log.error(msg)
-                elif dim_status == 'CustomerNotSubscribed':
-                    msg = f'Customer not subscribed to {config.product_code}'
-                    status[dimension] = {
-                        'error': msg,
-                        'status': 'failed'
-                    }
-                    log.error(msg)
-                else:
-                    status[dimension] = {
-                        'record_id': record_id,
-                        'status': 'submitted'
-                    }
-                    log.info(
-                        'New batch metered billing record '
-                        f'with ID: {record_id} for dimension: {dimension}'
-                    )
-
-            for record in response.get('UnprocessedRecords', []):
-                dimension = record['Dimension']
-                msg = f'Unable to process metering for dimension: {dimension}'
-                status[dimension] = {
-                    'error': msg,
-                    'status': 'failed'
-                }
+
+        exc = None
+        latency = time.perf_counter() - start
+        for record in response.get('Results', []):
+            customer = record['UsageRecord']['CustomerIdentifier']
+            dimension = record['UsageRecord']['Dimension']
+            record_id = record.get('MeteringRecordId', None)
+            dim_status = record.get('Status')
+
+            if not dim_status:
+                msg = f'Status unknown for dimension: {dimension}'
+                results.append(MeteringResult(
+                    customer,
+                    dimension,
+                    'failed',
+                    error=msg,
+                    latency=latency
+                ))
+                log.error(msg)
+            elif dim_status == 'CustomerNotSubscribed':
+                msg = f'Customer not subscribed to {config.product_code}'
+                results.append(MeteringResult(
+                    customer,
+                    dimension,
+                    'failed',
+                    error=msg,
+                    error_code=dim_status,
+                    latency=latency
+                ))
                 log.error(msg)
+            else:
+                results.append(MeteringResult(
+                    customer,
+                    dimension,
+                    'submitted',
+                    record_id,
+                    latency=latency
+                ))
+                log.info(
+                    'New batch metered billing record '
+                    f'with ID: {record_id} for dimension: {dimension}'
+                )
 
-            break
+        pending = response.get('UnprocessedRecords', [])
+
+        if pending:
+            log.info(f'Retrying {len(pending)} unprocessed records')
 
     if exc:
         msg = (
@@ -171,154 +757,1762 @@ def batch_meter_usage(
         )
         log.error(msg)
 
-        for record in records:
-            status[record['Dimension']] = {
-                'error': msg,
-                'status': 'failed'
-            }
+    latency = time.perf_counter() - start
+    for record in pending:
+        dimension = record['Dimension']
 
+        if not exc:
+            msg = f'Unable to process metering for dimension: {dimension}'
+            log.error(msg)
 
-@csp_billing_adapter.hookimpl(trylast=True)
-def meter_billing(
-    config: Config,
-    dimensions: dict,
-    timestamp: datetime,
-    dry_run: bool,
-    customer_id: str = None
-):
+        results.append(MeteringResult(
+            record['CustomerIdentifier'],
+            dimension,
+            'failed',
+            error=msg,
+            error_code=_get_error_code(exc),
+            latency=latency
+        ))
+
+    for result in results:
+        if result.status == 'submitted':
+            metrics.inc('metering_records_total', dimension=result.dimension)
+        else:
+            metrics.inc('metering_failures_total', dimension=result.dimension)
+
+    return results
+
+
+def _count_records(name: str, records: list):
+    """Increment the counter for the dimension of each usage record"""
+    for record in records:
+        metrics.inc(name, dimension=record['Dimension'])
+
+
+def _is_retryable_error(config: Config, error: Exception):
     """
-    Process a metered billing based on the dimensions provided
+    Return True if the request may succeed when retried
 
-    If a single dimension is provided the meter_usage API is
-    used for the metering. If there is an error the metering
-    is attempted 3 times before re-raising the exception to
-    calling scope.
+    If metering_retryable_errors is configured only those error
+    codes are retried, otherwise all but known permanent errors
+    are. Errors without an AWS error code, such as connection
+    errors, are considered transient. Requests rejected by an open
+    circuit breaker are not retried.
     """
-    region = get_region()
-    status = {}
+    if isinstance(error, CircuitOpenError):
+        return False
 
-    if customer_id:
-        batch_meter_usage(
-            status,
-            config,
-            region,
-            timestamp,
-            dimensions,
-            customer_id
-        )
-    else:
-        meter_usage(status, config, region, timestamp, dimensions, dry_run)
+    return _is_retryable_code(config, _get_error_code(error))
 
-    return status
 
+def _is_retryable_code(config: Config, code: str):
+    """Return True if the AWS error code, if any, is transient"""
+    if code is None:
+        return True
 
-@csp_billing_adapter.hookimpl(trylast=True)
-def get_csp_name(config: Config):
-    """Return CSP provider name"""
-    return 'amazon'
+    retryable_errors = config.get('metering_retryable_errors')
 
+    if retryable_errors:
+        return code in retryable_errors
 
-def get_region():
-    """Return the region name"""
-    api_header = _get_api_header()
-    document = _fetch_metadata('document', api_header)
-    metadata = json.loads(document)
-    region = metadata.get('region')
+    return code not in NON_RETRYABLE_ERRORS
 
-    if not region:
-        raise Exception('Unable to retrieve current region.')
 
-    return region
+def _get_backoff_delay(config: Config, attempt: int):
+    """Return the delay before a retry using exponential backoff"""
+    delay = min(
+        config.get('metering_retry_max_delay', RETRY_MAX_DELAY),
+        config.get('metering_retry_base_delay', RETRY_BASE_DELAY) *
+        2 ** (attempt - 1)
+    )
 
+    if config.get('metering_retry_jitter', True):
+        # Full jitter spreads out retries from concurrent callers
+        delay = random.uniform(0, delay)
 
-@csp_billing_adapter.hookimpl(trylast=True)
-def get_account_info(config: Config):
+    return delay
+
+
+def _wait_before_attempt(config: Config, attempt: int, deadline: float):
     """
-    Return a dictionary with account information
+    Wait before the next metering attempt
 
-    The information contains the metadata for document, signature and pkcs7.
+    The first attempt starts immediately. Return False if all
+    attempts are used or the deadline would pass before the next
+    attempt starts.
     """
-    account_info = _get_metadata()
-    account_info['document'] = json.loads(account_info.get('document', '{}'))
-    account_info['cloud_provider'] = get_csp_name(config)
+    if attempt >= config.get('metering_retry_attempts', RETRY_ATTEMPTS):
+        return False
 
-    return account_info
+    delay = _get_backoff_delay(config, attempt) if attempt else 0
 
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        log.error('Metering deadline exceeded')
+        return False
 
-def _get_ip_addr():
-    metadata_ip_addrs = {
-        'ipv6_addr': 'fd00:ec2::254',
-        'ipv4_addr': '169.254.169.254'
-    }
-    # Check if the Python implementation has IPv6 support in the first place
-    if not has_ipv6:
-        return metadata_ip_addrs.get('ipv4_addr')
+    if delay:
+        time.sleep(delay)
 
-    for ip_family, ip_addr in metadata_ip_addrs.items():
-        for i in range(3):
-            try:
-                socket = create_connection((ip_addr, 80), timeout=1)
-                socket.close()
-                if ip_family == 'ipv6_addr':
-                    # Make the IPv6 address http friendly
-                    ip_addr = f'[{ip_addr}]'
-
-                return ip_addr
-            except OSError:
-                # Cannot reach the network
-                break
-            except TimeoutError:
-                # Not ready yet wait a little bit
-                time.sleep(1)
+    return True
 
 
-def _get_api_header():
+@csp_billing_adapter.hookimpl(trylast=True)
+def meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool,
+    customer_id: str = None
+):
     """
-    Get the header to be used in requests
+    Process a metered billing based on the dimensions provided
+
+    If no customer_id is provided the meter_usage API is used
+    for the metering, otherwise the batch_meter_usage API is used.
+    Failed requests are retried with exponential backoff based on
+    the metering_retry_* config options, within the overall
+    metering_deadline if configured. Failures are reported in the
+    returned status.
 
-    Prefer IMDSv2 which requires a token.
+    If metering_journal_path is configured the usage is journaled
+    before submission and failed records are resubmitted in the
+    background. With metering_journal_async the usage is only
+    journaled and the dimensions are returned as queued.
+
+    If metering_buffer is enabled the usage is summed per hour and
+    submitted after the hour ends, the dimensions are returned as
+    buffered.
     """
-    ip_addr = _get_ip_addr()
-    request = urllib.request.Request(
-        f'http://{ip_addr}/latest/api/token',
-        headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'},
-        method='PUT'
+    usage = {customer_id: dimensions}
+    results = iter_meter_billing(
+        config,
+        dimensions,
+        timestamp,
+        dry_run,
+        customer_id
     )
 
-    try:
-        token = urllib.request.urlopen(request).read().decode()
-    except urllib.error.URLError as error:
-        error_message = f'Failed to retrieve metadata token: {str(error)}'
-        log.error(error_message)
-        raise Exception(error_message)
+    return _get_status(usage, results).get(customer_id, {})
 
-    return {'X-aws-ec2-metadata-token': token}
 
+def iter_meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool,
+    customer_id: str = None
+):
+    """
+    Meter the dimensions as in meter_billing, yielding the results
 
-def _get_metadata():
-    metadata_options = ['document', 'signature', 'pkcs7']
-    metadata = {}
-    request_header = _get_api_header()
+    A MeteringResult is yielded for each dimension as soon as its
+    request, or the batch it belongs to, completes. This allows the
+    caller to save progress while large usage is metered without
+    holding the status of all dimensions.
+    """
+    buffer = None if dry_run else _get_buffer(config)
 
-    for metadata_option in metadata_options:
-        metadata[metadata_option] = _fetch_metadata(
-            metadata_option,
-            request_header
+    if buffer is not None:
+        yield from _buffer_usage(
+            buffer,
+            {customer_id: dimensions},
+            timestamp
         )
+        return
 
-    return metadata
+    yield from _iter_meter_billing(
+        config,
+        dimensions,
+        timestamp,
+        dry_run,
+        customer_id
+    )
 
 
-def _fetch_metadata(uri, request_header):
-    """Return the response of the metadata request."""
-    ip_addr = _get_ip_addr()
-    url = f'http://{ip_addr}/latest/dynamic/instance-identity/{uri}'
-    data_request = urllib.request.Request(url, headers=request_header)
+def _iter_meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool,
+    customer_id: str = None
+):
+    """Meter the dimensions, journaling them if configured"""
+    journal = None if dry_run else _get_journal(config)
+
+    if journal and config.get('metering_journal_async'):
+        yield from _queue_usage(
+            journal,
+            {customer_id: dimensions},
+            timestamp
+        )
+        return
+
+    entry_ids = {}
+    if journal:
+        entry_ids = _journal_usage(
+            journal,
+            {customer_id: dimensions},
+            timestamp
+        )
+
+    try:
+        with span(
+            'meter_billing',
+            dimension_count=len(dimensions),
+            batch=bool(customer_id),
+            dry_run=bool(dry_run)
+        ):
+            region = get_region(config)
+            deadline = _get_deadline(config)
+
+            on_result = _get_journal_updater(config, journal, entry_ids)
+
+            if customer_id:
+                yield from _iter_batch_meter_usage(
+                    config,
+                    region,
+                    timestamp,
+                    {customer_id: dimensions},
+                    deadline,
+                    on_result
+                )
+            else:
+                yield from _iter_meter_usage(
+                    config,
+                    region,
+                    timestamp,
+                    dimensions,
+                    dry_run,
+                    deadline,
+                    on_result
+                )
+    except Exception as error:
+        if not journal:
+            raise
+
+        yield from _requeue_journal_entries(journal, entry_ids, error)
+    finally:
+        if journal:
+            _fail_journal_entries(journal, entry_ids)
+
+
+def meter_billing_customers(
+    config: Config,
+    usage: dict,
+    timestamp: datetime
+):
+    """
+    Process a metered billing for many customers at once
+
+    The usage is a mapping of customer_id to a dictionary of the
+    dimensions and quantities for that customer. The records of all
+    customers are coalesced into as few BatchMeterUsage requests as
+    possible. The status is returned per customer and per dimension.
+    The usage is journaled or buffered as in meter_billing.
+    """
+    results = iter_meter_billing_customers(config, usage, timestamp)
+    return _get_status(usage, results)
+
+
+def _get_status(usage: dict, results):
+    """
+    Return the status of each dimension per customer from the results
+
+    The customers and dimensions are in the order of the usage.
+    """
+    status = {}
+    for result in results:
+        status[(result.customer_id, result.dimension)] = result.to_status()
+
+    ordered = {}
+    for customer_id, dimensions in usage.items():
+        for dimension in dimensions:
+            key = (customer_id, dimension)
+
+            if key in status:
+                ordered.setdefault(customer_id, {})[dimension] = status[key]
+
+    return ordered
+
+
+def iter_meter_billing_customers(
+    config: Config,
+    usage: dict,
+    timestamp: datetime
+):
+    """
+    Meter the usage as in meter_billing_customers, yielding the results
+
+    A MeteringResult is yielded for each record as soon as the batch
+    it belongs to completes.
+    """
+    buffer = _get_buffer(config)
+
+    if buffer is not None:
+        yield from _buffer_usage(buffer, usage, timestamp)
+        return
+
+    yield from _iter_meter_billing_customers(config, usage, timestamp)
+
+
+def _iter_meter_billing_customers(
+    config: Config,
+    usage: dict,
+    timestamp: datetime
+):
+    """Meter the usage of the customers, journaling it if configured"""
+    journal = _get_journal(config)
+
+    if journal and config.get('metering_journal_async'):
+        yield from _queue_usage(journal, usage, timestamp)
+        return
+
+    entry_ids = {}
+    if journal:
+        entry_ids = _journal_usage(journal, usage, timestamp)
+
+    try:
+        with span('meter_billing_customers', customer_count=len(usage)):
+            region = get_region(config)
+            deadline = _get_deadline(config)
+
+            yield from _iter_batch_meter_usage(
+                config,
+                region,
+                timestamp,
+                usage,
+                deadline,
+                _get_journal_updater(config, journal, entry_ids)
+            )
+    except Exception as error:
+        if not journal:
+            raise
+
+        yield from _requeue_journal_entries(journal, entry_ids, error)
+    finally:
+        if journal:
+            _fail_journal_entries(journal, entry_ids)
+
+
+def _get_buffer(config: Config):
+    """
+    Return the hourly usage buffer
+
+    The buffer is created on first use, loading the entries saved to
+    metering_buffer_path if configured. The background flusher is
+    started and the buffer is flushed at exit. Return None if
+    metering_buffer is not enabled.
+
+    If the buffer is saved to a file, only the hours that have ended
+    are flushed at exit. The current hour is submitted after a
+    restart, once it has ended, so it is never submitted twice.
+    """
+    global _buffer
+
+    if not config.get('metering_buffer'):
+        return None
+
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = UsageBuffer(config.get('metering_buffer_path'))
+            flusher = threading.Thread(
+                target=_run_buffer_flusher,
+                args=(config, _buffer),
+                name='metering-buffer-flusher',
+                daemon=True
+            )
+            flusher.start()
+            _register_atexit(_flush_buffer_at_exit, config, _buffer)
+
+    return _buffer
+
+
+def _register_atexit(func, *args):
+    """
+    Call the function at exit before the thread pools are shut down
+
+    Thread pools refuse new work once the interpreter shuts them down,
+    which happens in the threading exit hooks since Python 3.9 and in
+    an atexit handler registered on import before that.
+    """
+    register = getattr(threading, '_register_atexit', atexit.register)
+    register(func, *args)
+
+
+def _flush_buffer_at_exit(config: Config, buffer: UsageBuffer):
+    """
+    Flush the buffer at exit unless it was dropped
+
+    If the buffer is saved to a file only the hours that have ended
+    are submitted.
+    """
+    if buffer is not _buffer:
+        return
+
+    try:
+        _flush_buffer(config, buffer, bool(config.get('metering_buffer_path')))
+    except Exception as error:
+        log.error(f'Failed to flush metering buffer: {str(error)}')
+
+
+def _buffer_usage(buffer: UsageBuffer, usage: dict, timestamp: datetime):
+    """
+    Add the usage to the hourly buffer
+
+    Return the result of each dimension per customer.
+    """
+    buffer.add(usage, timestamp)
+
+    return [
+        MeteringResult(customer_id, dimension, 'buffered')
+        for customer_id, dimensions in usage.items()
+        for dimension in dimensions
+    ]
+
+
+def _run_buffer_flusher(config: Config, buffer: UsageBuffer):
+    """Flush the buffered usage of each hour once the hour has ended"""
+    delay = config.get('metering_buffer_flush_delay', BUFFER_FLUSH_DELAY)
+
+    while True:
+        now = datetime.now(timezone.utc)
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + \
+            timedelta(hours=1)
+        _buffer_wakeup.wait((next_hour - now).total_seconds() + delay)
+        _buffer_wakeup.clear()
+
+        try:
+            _flush_buffer(config, buffer)
+        except Exception as error:
+            log.error(f'Failed to flush metering buffer: {str(error)}')
+
+
+def _flush_buffer(config: Config, buffer: UsageBuffer, due: bool = True):
+    """
+    Submit the buffered usage
+
+    If due is set only the hours that have ended are submitted,
+    otherwise all of them. The usage of an hour is submitted with
+    the latest timestamp reported for it, customers in batches and
+    usage without a customer one dimension at a time. Entries that
+    could not be submitted are put back, see _flush_entries.
+    """
+    entries = buffer.pop(datetime.now(timezone.utc) if due else None)
+
+    if not entries:
+        return
+
+    log.info(f'Flushing {len(entries)} buffered metering records')
+
+    hours = {}
+    for entry in entries:
+        hours.setdefault(entry['hour'], []).append(entry)
+
+    for hour, hour_entries in sorted(hours.items()):
+        timestamp = max(entry['timestamp'] for entry in hour_entries)
+
+        for has_customer in (False, True):
+            _flush_entries(
+                config,
+                buffer,
+                [
+                    entry for entry in hour_entries
+                    if (entry['customer_id'] is not None) == has_customer
+                ],
+                timestamp
+            )
+
+
+def _flush_entries(
+    config: Config,
+    buffer: UsageBuffer,
+    entries: list,
+    timestamp: datetime
+):
+    """
+    Submit buffered entries either all with or all without a customer
+
+    Entries that failed with a transient error, or were not submitted
+    because of an error, are put back in the buffer. Records failed
+    with a permanent error are dropped. Records queued in the journal
+    are left to it.
+    """
+    if not entries:
+        return
+
+    usage = {}
+    for entry in entries:
+        usage.setdefault(entry['customer_id'], {})[
+            entry['dimension']
+        ] = entry['quantity']
+
+    settled = set()
+    try:
+        if None in usage:
+            results = _iter_meter_billing(
+                config,
+                usage[None],
+                timestamp,
+                False
+            )
+        else:
+            results = _iter_meter_billing_customers(config, usage, timestamp)
+
+        for result in results:
+            if result.status != 'failed' or \
+                    not _is_retryable_code(config, result.error_code):
+                settled.add((result.customer_id, result.dimension))
+    except Exception as error:
+        log.error(f'Failed to flush buffered metering: {str(error)}')
+
+    unsettled = [
+        entry for entry in entries
+        if (entry['customer_id'], entry['dimension']) not in settled
+    ]
+
+    if unsettled:
+        log.info(f'Keeping {len(unsettled)} metering records buffered')
+        buffer.restore(unsettled)
+
+
+def _get_journal(config: Config):
+    """
+    Return the metering journal
+
+    The journal is opened on first use and the background drainer
+    is started. Return None if metering_journal_path is not
+    configured.
+    """
+    global _journal
+
+    path = config.get('metering_journal_path')
+
+    if not path:
+        return None
+
+    with _journal_lock:
+        if _journal is None:
+            _journal = MeteringJournal(path)
+            drainer = threading.Thread(
+                target=_run_journal_drainer,
+                args=(config, _journal),
+                name='metering-journal-drainer',
+                daemon=True
+            )
+            drainer.start()
+
+    return _journal
+
+
+def _journal_usage(
+    journal: MeteringJournal,
+    usage: dict,
+    timestamp: datetime,
+    state: str = PENDING
+):
+    """
+    Append the usage of each customer to the journal
+
+    Return the entry ids keyed by customer and dimension.
+    """
+    keys = [
+        (customer_id, dimension)
+        for customer_id, dimensions in usage.items()
+        for dimension in dimensions
+    ]
+    entry_ids = journal.append(
+        [
+            (customer_id, dimension, usage[customer_id][dimension], timestamp)
+            for customer_id, dimension in keys
+        ],
+        state
+    )
+
+    return dict(zip(keys, entry_ids))
+
+
+def _queue_usage(journal: MeteringJournal, usage: dict, timestamp: datetime):
+    """
+    Queue the usage for submission by the journal drainer
+
+    Return the result of each dimension per customer.
+    """
+    entry_ids = _journal_usage(
+        journal,
+        usage,
+        timestamp,
+        QUEUED
+    )
+    _journal_wakeup.set()
+
+    return [
+        MeteringResult(customer_id, dimension, 'queued')
+        for customer_id, dimension in entry_ids
+    ]
+
+
+def _update_journal_entry(
+    config: Config,
+    journal: MeteringJournal,
+    entry_id: int,
+    result: MeteringResult
+):
+    """
+    Record the result of the entry in the journal
+
+    Submitted entries are acknowledged. Entries failed with a
+    transient error are left to the drainer and their result is
+    returned as queued, so the caller does not submit them again.
+    Entries failed with a permanent error are rejected and their
+    failure is returned.
+    """
+    if result.status == 'submitted':
+        journal.acknowledge(entry_id, result.record_id)
+    elif _is_retryable_code(config, result.error_code):
+        journal.fail(entry_id, result.error_code)
+        return result._replace(status='queued')
+    else:
+        journal.reject(entry_id, result.error_code)
+
+    return result
+
+
+def _get_journal_updater(
+    config: Config,
+    journal: MeteringJournal,
+    entry_ids: dict
+):
+    """
+    Return a callback recording each result in the journal
+
+    The callback returns the result to report, see
+    _update_journal_entry. The entry of each result is removed from
+    entry_ids, so the entries left were never submitted. Return None
+    without a journal.
+    """
+    if not journal:
+        return None
+
+    def update_journal(result: MeteringResult):
+        return _update_journal_entry(
+            config,
+            journal,
+            entry_ids.pop((result.customer_id, result.dimension)),
+            result
+        )
+
+    return update_journal
+
+
+def _fail_journal_entries(
+    journal: MeteringJournal,
+    entry_ids: dict,
+    error_code: str = None
+):
+    """
+    Mark the entries without a result failed
+
+    This is the case if metering raised or the generator was closed
+    before the records were submitted.
+    """
+    for entry_id in entry_ids.values():
+        journal.fail(entry_id, error_code)
+
+
+def _requeue_journal_entries(
+    journal: MeteringJournal,
+    entry_ids: dict,
+    error: Exception
+):
+    """
+    Leave the entries without a result to the journal drainer
+
+    Yield a queued result for each of them, the error is not raised
+    since the journal resubmits the records.
+    """
+    log.error(
+        f'Failed to meter bill, records left to the journal: {str(error)}'
+    )
+    error_code = _get_error_code(error)
+    keys = list(entry_ids)
+    _fail_journal_entries(journal, entry_ids, error_code)
+    entry_ids.clear()
+
+    for customer_id, dimension in keys:
+        yield MeteringResult(
+            customer_id,
+            dimension,
+            'queued',
+            error=str(error),
+            error_code=error_code
+        )
+
+
+def _run_journal_drainer(config: Config, journal: MeteringJournal):
+    """Periodically resubmit the unsubmitted journal entries"""
+    interval = config.get(
+        'metering_journal_drain_interval',
+        JOURNAL_DRAIN_INTERVAL
+    )
+
+    while True:
+        _journal_wakeup.wait(interval)
+        _journal_wakeup.clear()
+
+        try:
+            _drain_journal(config, journal)
+        except Exception as error:
+            log.error(f'Failed to drain metering journal: {str(error)}')
+
+
+def _drain_journal(config: Config, journal: MeteringJournal):
+    """
+    Submit the unsubmitted journal entries
+
+    Entries with a customer are submitted in batches grouped by
+    timestamp, the others one dimension at a time. Entries that last
+    failed with a permanent error are rejected instead. Acknowledged
+    and rejected entries past the retention period are removed.
+    """
+    entries = []
+    for entry in journal.get_unsubmitted(
+        config.get('metering_journal_max_attempts', JOURNAL_MAX_ATTEMPTS)
+    ):
+        if _is_retryable_code(config, entry['error_code']):
+            entries.append(entry)
+        else:
+            journal.reject(entry['id'], entry['error_code'])
+
+    if entries:
+        log.info(f'Resubmitting {len(entries)} journaled metering records')
+        region = get_region(config)
+
+    batches = {}
+    for entry in entries:
+        if entry['customer_id'] is None:
+            result = _meter_dimension(
+                config,
+                region,
+                entry['timestamp'],
+                entry['dimension'],
+                entry['quantity'],
+                False
+            )
+            _update_journal_entry(config, journal, entry['id'], result)
+        else:
+            batches.setdefault(entry['timestamp'], []).append(entry)
+
+    for timestamp, batch in batches.items():
+        usage = {}
+        entry_ids = {}
+        for entry in batch:
+            key = (entry['customer_id'], entry['dimension'])
+            usage.setdefault(key[0], {})[key[1]] = entry['quantity']
+            entry_ids.setdefault(key, []).append(entry['id'])
+
+        records = _get_usage_records(timestamp, usage)
+
+        for result in _iter_batch_meter_records(config, region, records):
+            for entry_id in entry_ids.pop(
+                (result.customer_id, result.dimension),
+                []
+            ):
+                _update_journal_entry(config, journal, entry_id, result)
+
+        for ids in entry_ids.values():
+            for entry_id in ids:
+                journal.fail(entry_id)
+
+    journal.prune(
+        config.get('metering_journal_retention', JOURNAL_RETENTION)
+    )
+
+
+def _get_deadline(config: Config):
+    """
+    Return the monotonic time by which metering must complete
+
+    Return None if metering_deadline is not configured.
+    """
+    timeout = config.get('metering_deadline')
+
+    if timeout is None:
+        return None
+
+    return time.monotonic() + timeout
+
+
+@csp_billing_adapter.hookimpl(trylast=True)
+def get_csp_name(config: Config):
+    """Return CSP provider name"""
+    return 'amazon'
+
+
+def get_region(config: Config = None):
+    """
+    Return the region name
+
+    The region is resolved by the first of the region_resolvers that
+    returns one, by default in order:
+
+    - config: The aws_region config option
+    - environment: The AWS_REGION or AWS_DEFAULT_REGION variables
+    - ecs: The ECS task metadata endpoint, when running in ECS
+    - imds: The instance identity document
+
+    Resolvers that fail or time out are skipped.
+    """
+    resolvers = REGION_RESOLVERS
+    if config:
+        resolvers = config.get('region_resolvers', REGION_RESOLVERS)
+
+    with span('get_region') as current_span:
+        region = _resolve('region', _region_resolvers, resolvers, config)
+
+        if not region:
+            raise Exception('Unable to retrieve current region.')
+
+        current_span.set_attribute('aws.region', region)
+
+    return region
+
+
+@csp_billing_adapter.hookimpl(trylast=True)
+def get_account_info(config: Config):
+    """
+    Return a dictionary with account information
+
+    The information contains the metadata for document, signature and pkcs7.
+    It is resolved by the first of the identity_resolvers that returns
+    it, by default the instance identity from the metadata service and
+    then the ECS task metadata. The ECS identity document has no
+    signature or pkcs7.
+
+    An exception is raised if no resolver returns the identity, so
+    the adapter retries instead of saving empty account information.
+    """
+    account_info = _resolve(
+        'identity',
+        _identity_resolvers,
+        config.get('identity_resolvers', IDENTITY_RESOLVERS),
+        config
+    )
+
+    if not account_info:
+        raise Exception('Unable to retrieve account info.')
+
+    account_info['document'] = json.loads(account_info['document'])
+    account_info['cloud_provider'] = get_csp_name(config)
+
+    return account_info
+
+
+def _resolve(name: str, functions: dict, resolvers: list, config: Config):
+    """Return the result of the first resolver that returns one"""
+    for resolver in resolvers:
+        try:
+            value = functions[resolver](config)
+        except Exception as error:
+            log.warning(
+                f'Unable to resolve {name} from {resolver}: {str(error)}'
+            )
+            continue
+
+        if value:
+            log.debug(f'Resolved {name} from {resolver}')
+            return value
+
+    return None
+
+
+def _get_config_region(config: Config):
+    """Return the region from the aws_region config option"""
+    return config.get('aws_region') if config else None
+
+
+def _get_environment_region(config: Config):
+    """Return the region from the AWS environment variables"""
+    return os.environ.get('AWS_REGION') or \
+        os.environ.get('AWS_DEFAULT_REGION')
+
+
+def _get_ecs_region(config: Config):
+    """Return the region of the ECS task"""
+    task = _get_ecs_task_metadata(config)
+
+    if not task:
+        return None
+
+    # arn:aws:ecs:<region>:<account>:task/<cluster>/<id>
+    return task['TaskARN'].split(':')[3]
+
+
+def _get_imds_region(config: Config):
+    """Return the region from the instance identity document"""
+    document = _get_identity().get('document')
+    return json.loads(document or '{}').get('region')
+
+
+def _get_imds_identity(config: Config):
+    """
+    Return the instance identity if it was fully retrieved
+
+    An identity missing the signature or pkcs7 is not returned, so it
+    is never saved as the account information.
+    """
+    identity = _get_identity()
+    return identity if _is_complete_identity(identity) else None
+
+
+def _get_ecs_identity(config: Config):
+    """
+    Return an identity document built from the ECS task metadata
+
+    The task metadata is not signed, signature and pkcs7 are None.
+    """
+    task = _get_ecs_task_metadata(config)
+
+    if not task:
+        return None
+
+    arn = task['TaskARN'].split(':')
+    document = {
+        'accountId': arn[4],
+        'availabilityZone': task.get('AvailabilityZone'),
+        'cluster': task.get('Cluster'),
+        'launchType': task.get('LaunchType'),
+        'region': arn[3],
+        'taskArn': task['TaskARN']
+    }
+
+    return {
+        'document': json.dumps(document),
+        'signature': None,
+        'pkcs7': None
+    }
+
+
+_region_resolvers = {
+    'config': _get_config_region,
+    'environment': _get_environment_region,
+    'ecs': _get_ecs_region,
+    'imds': _get_imds_region
+}
+_identity_resolvers = {
+    'imds': _get_imds_identity,
+    'ecs': _get_ecs_identity
+}
+
+
+def _get_ecs_task_metadata(config: Config):
+    """
+    Return the ECS task metadata
+
+    The metadata is read from the task metadata endpoint v4 once and
+    served from memory afterwards. Return None if not running in ECS.
+    The request times out after ecs_metadata_timeout seconds.
+    """
+    uri = os.environ.get('ECS_CONTAINER_METADATA_URI_V4')
+
+    if not uri:
+        return None
+
+    with _ecs_task_metadata_lock:
+        if _ecs_task_metadata:
+            return dict(_ecs_task_metadata)
+
+        timeout = ECS_METADATA_TIMEOUT
+        if config:
+            timeout = config.get('ecs_metadata_timeout', timeout)
+
+        endpoint = urlsplit(uri)
+        connection = HTTPConnection(endpoint.netloc, timeout=timeout)
+
+        try:
+            connection.request('GET', f'{endpoint.path.rstrip("/")}/task')
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise Exception(
+                'Failed to retrieve ECS task metadata: '
+                f'HTTP Error {response.status}'
+            )
+
+        _ecs_task_metadata.update(json.loads(body))
+        return dict(_ecs_task_metadata)
+
+
+def _get_client(config: Config, region: str):
+    """
+    Return the shared metering client for the region
+
+    Clients are created lazily on first use and reused by every
+    metering call in the process. This keeps the HTTP connection
+    pool, endpoint resolution and credentials alive between calls.
+    The pool size is set with the metering_max_pool_connections
+    config option.
+    """
+    profile = config.get('aws_profile')
+    key = (region, profile)
+
+    with _clients_lock:
+        client = _clients.get(key)
+
+        if client is None:
+            _load_boto3()
+            client_config = BotoConfig(
+                max_pool_connections=config.get(
+                    'metering_max_pool_connections',
+                    DEFAULT_MAX_POOL_CONNECTIONS
+                ),
+                tcp_keepalive=config.get('metering_tcp_keepalive', True),
+                # Retries are handled by the plugin retry policy
+                retries={'total_max_attempts': 1}
+            )
+
+            with metrics.timer('client_create_seconds'):
+                client = _get_session(config).client(
+                    METERING_SERVICE,
+                    region_name=region,
+                    endpoint_url=config.get('metering_endpoint_url'),
+                    config=client_config
+                )
+
+            _clients[key] = client
+
+    return client
+
+
+def _load_boto3():
+    """
+    Import boto3 and botocore on first use
+
+    Importing them takes a noticeable time and memory, which is
+    only spent if the adapter meters usage.
+    """
+    global boto3, BotoConfig, SharedCredentialsProvider
+
+    with _boto3_lock:
+        if boto3 is None:
+            import boto3
+
+        if BotoConfig is None:
+            from botocore.config import Config as BotoConfig
+
+        if SharedCredentialsProvider is None:
+            from csp_billing_adapter_amazon.credentials import (
+                SharedCredentialsProvider
+            )
+
+
+def _get_session(config: Config):
+    """
+    Return the shared boto3 session for the aws_profile
+
+    The session credentials are served by a SharedCredentialsProvider,
+    which caches them and refreshes temporary credentials in the
+    background credentials_refresh_margin seconds before they expire.
+    """
+    profile = config.get('aws_profile')
+
+    with _sessions_lock:
+        if profile not in _sessions:
+            provider = SharedCredentialsProvider(profile)
+            refresh_margin = config.get('credentials_refresh_margin')
+
+            if refresh_margin is not None:
+                provider.refresh_margin = refresh_margin
+
+            session = boto3.session.Session(
+                botocore_session=provider.create_session()
+            )
+            _sessions[profile] = (session, provider)
+
+        return _sessions[profile][0]
+
+
+def _reset_session(profile: str):
+    """Drop the shared session and stop refreshing its credentials"""
+    with _sessions_lock:
+        session, provider = _sessions.pop(profile, (None, None))
+
+    if provider:
+        provider.stop()
+
+
+def _call_metering(
+    config: Config,
+    region: str,
+    operation: str,
+    deadline: float = None,
+    **kwargs
+):
+    """
+    Call the metering API operation with the shared client
+
+    If metering_rate_limit is configured the call waits for the
+    region rate limiter, which adapts its rate to throttling.
+
+    While the region circuit breaker is open the call fails
+    immediately with a CircuitOpenError.
+    """
+    breaker = _get_breaker(config, region)
+
+    if breaker and not breaker.allow():
+        metrics.inc('circuit_breaker_rejected_total', endpoint='metering')
+        raise CircuitOpenError(f'Metering circuit open for {region}')
+
+    limiter = _get_rate_limiter(config, region)
+
+    try:
+        if limiter:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+
+            if not limiter.acquire(timeout):
+                raise Exception('Metering deadline exceeded')
+
+        client = _get_client(config, region)
+    except BaseException:
+        # The request was not sent, a probe must be left to another call
+        if breaker:
+            breaker.release()
+        raise
+
+    records = kwargs.get('UsageRecords')
+
+    with span(
+        f'metering.{operation}',
+        **{
+            'aws.region': region,
+            'metering.dimension': kwargs.get('UsageDimension'),
+            'metering.record_count': len(records) if records else 1
+        }
+    ) as current_span:
+        try:
+            with metrics.timer(
+                'metering_request_seconds',
+                operation=operation
+            ):
+                response = getattr(client, operation)(**kwargs)
+        except Exception as error:
+            error_code = _get_error_code(error)
+            code = error_code or type(error).__name__
+            current_span.set_attribute('aws.error_code', code)
+
+            # Errors returned by the API mean the endpoint is up
+            _update_breaker(
+                breaker,
+                'metering',
+                error_code is None or error_code in SERVICE_ERRORS
+            )
+            metrics.inc(
+                'metering_errors_total',
+                operation=operation,
+                code=code
+            )
+
+            if limiter and code in THROTTLING_ERRORS:
+                limiter.on_throttle()
+            raise
+
+        if 'UnprocessedRecords' in response:
+            current_span.set_attribute(
+                'metering.unprocessed_count',
+                len(response['UnprocessedRecords'])
+            )
+
+    _update_breaker(breaker, 'metering', False)
+
+    if limiter:
+        limiter.on_success()
+
+    return response
+
+
+def _get_breaker(config: Config, region: str):
+    """
+    Return the shared circuit breaker for the region
+
+    The circuit opens after metering_breaker_threshold consecutive
+    failed requests and a probe is sent after metering_breaker_timeout
+    seconds. Return None if the threshold is set to 0.
+    """
+    threshold = config.get('metering_breaker_threshold', BREAKER_THRESHOLD)
+
+    if not threshold:
+        return None
+
+    with _breakers_lock:
+        breaker = _breakers.get(region)
+
+        if breaker is None:
+            breaker = CircuitBreaker(
+                threshold,
+                config.get('metering_breaker_timeout', BREAKER_TIMEOUT)
+            )
+            _breakers[region] = breaker
+
+    return breaker
+
+
+def _update_breaker(breaker: CircuitBreaker, endpoint: str, failed: bool):
+    """Record the outcome of a request in the circuit breaker"""
+    if breaker is None:
+        return
+
+    if not failed:
+        breaker.on_success()
+    elif breaker.on_failure():
+        log.warning(f'Circuit opened for the {endpoint} endpoint')
+        metrics.inc('circuit_breaker_opened_total', endpoint=endpoint)
+
+
+def _get_rate_limiter(config: Config, region: str):
+    """
+    Return the shared rate limiter for the region
+
+    Return None if metering_rate_limit is not configured.
+    """
+    rate = config.get('metering_rate_limit')
+
+    if not rate:
+        return None
+
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(region)
+
+        if limiter is None:
+            limiter = RateLimiter(
+                rate,
+                burst=config.get('metering_rate_burst')
+            )
+            _rate_limiters[region] = limiter
+
+    return limiter
+
+
+def _invalidate_client(config: Config, region: str):
+    """
+    Drop the shared metering clients so they are re-created on next use
+
+    The shared session is dropped too so the credentials are resolved
+    again. Its provider stops refreshing, so the clients of every
+    region using the profile are dropped, not only the failing one.
+    """
+    profile = config.get('aws_profile')
+
+    with _clients_lock:
+        for key in [key for key in _clients if key[1] == profile]:
+            del _clients[key]
+
+    _reset_session(profile)
+
+
+def _get_error_code(error: Exception):
+    """Return the AWS error code for a botocore client error if any"""
+    response = getattr(error, 'response', None)
+
+    if not isinstance(response, dict):
+        return None
+
+    return response.get('Error', {}).get('Code')
+
+
+def _handle_client_error(error: Exception, config: Config, region: str):
+    """
+    Invalidate the shared client if the credentials have expired
+
+    The client is re-created with a fresh credential lookup on the
+    next attempt.
+    """
+    if _get_error_code(error) in EXPIRED_CREDENTIALS_ERRORS:
+        log.info(f'Credentials expired, resetting client for {region}')
+        _invalidate_client(config, region)
+
+
+def _get_ip_addr(refresh: bool = False):
+    """
+    Return the address of the instance metadata endpoint
+
+    The endpoint is probed once and the result is memoized for the
+    lifetime of the process. Set refresh to force a new probe, this
+    happens automatically after a connection failure.
+
+    If the AWS_EC2_METADATA_SERVICE_ENDPOINT environment variable is
+    set its host and port are used without probing.
+    """
+    global _imds_ip_addr
+
+    endpoint = os.environ.get('AWS_EC2_METADATA_SERVICE_ENDPOINT')
+
+    if endpoint:
+        return urlsplit(endpoint).netloc
+
+    with _imds_ip_addr_lock:
+        if _imds_ip_addr and not refresh:
+            return _imds_ip_addr
+
+        with span('imds.get_ip_addr') as current_span, \
+                metrics.timer('imds_probe_seconds'):
+            ip_addr = _probe_ip_addr()
+
+            if ip_addr:
+                current_span.set_attribute('imds.address', ip_addr)
+
+        if ip_addr:
+            _imds_ip_addr = ip_addr
+
+        return ip_addr
+
+
+def _reset_ip_addr():
+    """Forget the memoized metadata endpoint address"""
+    global _imds_ip_addr
+
+    with _imds_ip_addr_lock:
+        _imds_ip_addr = None
+
+
+def _probe_ip_addr():
+    """
+    Probe the IPv6 and IPv4 metadata endpoints concurrently
+
+    IPv6 is preferred. If IPv4 answers first the IPv6 probe is given
+    a short grace period before falling back to IPv4.
+    """
+    # Check if the Python implementation has IPv6 support in the first place
+    if not has_ipv6:
+        return IMDS_IPV4_ADDR
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    ipv6 = executor.submit(_probe_endpoint, IMDS_IPV6_ADDR)
+    ipv4 = executor.submit(_probe_endpoint, IMDS_IPV4_ADDR)
+    executor.shutdown(wait=False)
+
+    pending = {ipv6, ipv4}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        if ipv6 in done and ipv6.result():
+            # Make the IPv6 address http friendly
+            return f'[{IMDS_IPV6_ADDR}]'
+
+        if ipv4 in done and ipv4.result():
+            if ipv6 in pending:
+                try:
+                    if ipv6.result(timeout=IPV6_PREFERENCE_DELAY):
+                        return f'[{IMDS_IPV6_ADDR}]'
+                except FuturesTimeoutError:
+                    pass
+
+            return IMDS_IPV4_ADDR
+
+
+def _probe_endpoint(ip_addr: str):
+    """
+    Return True if a connection to the address can be opened
+
+    A single attempt is made, unreachable and timed out endpoints are
+    not retried.
+    """
+    try:
+        sock = create_connection((ip_addr, 80), timeout=1)
+        sock.close()
+        return True
+    except OSError:
+        # Cannot reach the network or the connection timed out
+        return False
+
+
+def _start_metrics_server(config: Config):
+    """Serve the metrics on metrics_port once per process"""
+    global _metrics_server
+
+    port = config.get('metrics_port')
+
+    if port is None:
+        return
+
+    with _metrics_server_lock:
+        if _metrics_server:
+            return
+
+        try:
+            _metrics_server = metrics.serve(
+                port,
+                config.get('metrics_host', '127.0.0.1')
+            )
+        except OSError as error:
+            log.warning(f'Unable to serve metrics: {str(error)}')
+
+
+def _configure_imds(config: Config):
+    """Apply the metadata connection settings from the config"""
+    for setting in _imds_settings:
+        value = config.get(f'imds_{setting}')
+
+        if value is not None:
+            _imds_settings[setting] = value
+
+
+def _imds_request(method: str, path: str, headers: dict):
+    """
+    Send a request to the instance metadata endpoint
+
+    While the metadata circuit breaker is open the request fails
+    immediately with a CircuitOpenError, without probing the
+    endpoint.
+
+    Return the response status and body.
+    """
+    breaker = _get_imds_breaker()
+
+    if breaker and not breaker.allow():
+        metrics.inc('circuit_breaker_rejected_total', endpoint='imds')
+        raise CircuitOpenError('Metadata circuit open')
+
+    try:
+        response = _send_pooled_imds_request(method, path, headers)
+    except IMDS_CONNECTION_ERRORS:
+        _update_breaker(breaker, 'imds', True)
+        raise
+    except BaseException:
+        if breaker:
+            breaker.release()
+        raise
+
+    _update_breaker(breaker, 'imds', False)
+    return response
+
+
+def _get_imds_breaker():
+    """
+    Return the metadata circuit breaker
+
+    Return None if imds_breaker_threshold is set to 0.
+    """
+    global _imds_breaker
+
+    if not _imds_settings['breaker_threshold']:
+        return None
+
+    with _imds_breaker_lock:
+        if _imds_breaker is None:
+            _imds_breaker = CircuitBreaker(
+                _imds_settings['breaker_threshold'],
+                _imds_settings['breaker_timeout']
+            )
+
+    return _imds_breaker
+
+
+def _send_pooled_imds_request(method: str, path: str, headers: dict):
+    """
+    Send the request on a pooled keep-alive connection
+
+    A request that fails on a reused connection, which may have been
+    closed by the endpoint, is retried once on a new connection.
+    Connection failures reset the endpoint address so it is probed
+    again on the next request. A ConnectionError is raised if no
+    endpoint address answers the probe.
+    """
+    ip_addr = _get_ip_addr()
+
+    if not ip_addr:
+        raise ConnectionError('Metadata endpoint unreachable')
+
+    connection = _get_imds_connection(ip_addr)
+    reused = connection.sock is not None
+
+    try:
+        return _send_imds_request(connection, ip_addr, method, path, headers)
+    except IMDS_CONNECTION_ERRORS:
+        if not reused:
+            _reset_ip_addr()
+            raise
+
+    connection = _get_imds_connection(ip_addr, reuse=False)
+
+    try:
+        return _send_imds_request(connection, ip_addr, method, path, headers)
+    except IMDS_CONNECTION_ERRORS:
+        _reset_ip_addr()
+        raise
+
+
+def _send_imds_request(
+    connection: HTTPConnection,
+    ip_addr: str,
+    method: str,
+    path: str,
+    headers: dict
+):
+    """Send the request and return the connection to the pool"""
+    try:
+        if connection.sock is None:
+            connection.connect()
+            connection.sock.settimeout(_imds_settings['read_timeout'])
+
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+    except IMDS_CONNECTION_ERRORS:
+        connection.close()
+        raise
+
+    if response.will_close:
+        connection.close()
+    else:
+        _release_imds_connection(ip_addr, connection)
+
+    return response.status, body
+
+
+def _get_imds_connection(ip_addr: str, reuse: bool = True):
+    """Return an idle pooled connection or a new one"""
+    with _imds_connections_lock:
+        idle = _imds_connections.get(ip_addr, [])
+
+        if reuse and idle:
+            return idle.pop()
+
+    # The address may include a port, the default is port 80
+    return HTTPConnection(
+        ip_addr,
+        timeout=_imds_settings['connect_timeout']
+    )
+
+
+def _release_imds_connection(ip_addr: str, connection: HTTPConnection):
+    """Return the connection to the pool of idle connections"""
+    with _imds_connections_lock:
+        idle = _imds_connections.setdefault(ip_addr, [])
+
+        if len(idle) < _imds_settings['max_connections']:
+            idle.append(connection)
+            return
+
+    connection.close()
+
+
+def _close_imds_connections():
+    """Close all idle metadata connections"""
+    with _imds_connections_lock:
+        for idle in _imds_connections.values():
+            for connection in idle:
+                connection.close()
+
+        _imds_connections.clear()
+
+
+def _get_api_header(refresh: bool = False):
+    """
+    Get the header to be used in requests
+
+    Prefer IMDSv2 which requires a token. The token is cached and
+    reused until shortly before its TTL expires. Set refresh to
+    request a new token regardless.
+    """
+    global _imds_token, _imds_token_expires
+
+    with _imds_token_lock:
+        if refresh or not _imds_token or \
+                time.monotonic() >= _imds_token_expires:
+            try:
+                with span('imds.get_api_header', refresh=refresh), \
+                        metrics.timer('imds_token_seconds'):
+                    _imds_token = _request_api_token()
+            except Exception:
+                metrics.inc('imds_token_failures_total')
+                raise
+
+            _imds_token_expires = (
+                time.monotonic() + IMDS_TOKEN_TTL - IMDS_TOKEN_REFRESH_MARGIN
+            )
+
+        return {'X-aws-ec2-metadata-token': _imds_token}
+
+
+def _reset_api_token():
+    """Forget the cached metadata token"""
+    global _imds_token, _imds_token_expires
+
+    with _imds_token_lock:
+        _imds_token = None
+        _imds_token_expires = 0
+
+
+def _request_api_token():
+    """Request a new IMDSv2 token from the metadata endpoint"""
+    try:
+        status, body = _imds_request(
+            'PUT',
+            '/latest/api/token',
+            {'X-aws-ec2-metadata-token-ttl-seconds': str(IMDS_TOKEN_TTL)}
+        )
+    except IMDS_CONNECTION_ERRORS as error:
+        error_message = f'Failed to retrieve metadata token: {str(error)}'
+
+        if isinstance(error, socket.timeout):
+            # The token response is dropped when the container is more
+            # hops away from the endpoint than the instance hop limit.
+            error_message += (
+                '. If running in a container the instance metadata '
+                'hop limit may need to be increased to 2.'
+            )
+
+        log.error(error_message)
+        raise Exception(error_message)
+
+    if status != 200:
+        error_message = (
+            f'Failed to retrieve metadata token: HTTP Error {status}'
+        )
+        log.error(error_message)
+        raise Exception(error_message)
+
+    return body.decode()
+
+
+def _get_metadata():
+    """
+    Return the instance identity document, signature and pkcs7
+
+    The resources are fetched concurrently with a single shared
+    token. Resources not retrieved within the imds_metadata_timeout
+    are returned as None.
+    """
+    request_header = _get_api_header()
+
+    executor = ThreadPoolExecutor(max_workers=len(IDENTITY_OPTIONS))
+    futures = {
+        metadata_option: executor.submit(
+            _fetch_metadata,
+            metadata_option,
+            request_header
+        )
+        for metadata_option in IDENTITY_OPTIONS
+    }
+    executor.shutdown(wait=False)
+
+    done, not_done = wait(
+        futures.values(),
+        timeout=_imds_settings['metadata_timeout']
+    )
+
+    metadata = {}
+    for metadata_option, future in futures.items():
+        if future in done:
+            metadata[metadata_option] = future.result()
+        else:
+            log.error(f'Timed out retrieving metadata for: {metadata_option}')
+            metadata[metadata_option] = None
+
+    return metadata
+
+
+def _get_identity():
+    """
+    Return the instance identity metadata
+
+    The identity document is immutable for the life of the instance,
+    so it is fetched once and served from memory afterwards.
+    Incomplete responses are not cached.
+    """
+    with _identity_lock:
+        if _identity:
+            return dict(_identity)
+
+        metadata = _get_metadata()
+
+        if _is_complete_identity(metadata):
+            _identity.update(metadata)
+
+        return metadata
+
+
+def _is_complete_identity(identity: dict):
+    """Return True if document, signature and pkcs7 are all present"""
+    return all(identity.get(option) for option in IDENTITY_OPTIONS)
+
+
+def _save_identity(cache_file: str, identity: dict):
+    """Persist the instance identity to the cache file"""
+    try:
+        fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as identity_file:
+            json.dump(identity, identity_file)
+    except OSError as error:
+        log.warning(
+            f'Unable to save instance identity to {cache_file}: {str(error)}'
+        )
+
+
+def _load_identity(cache_file: str):
+    """
+    Populate the identity cache from the cache file
+
+    The document is only accepted along with its signature and pkcs7
+    so the account info remains verifiable.
+    """
+    try:
+        with open(cache_file) as identity_file:
+            identity = json.load(identity_file)
+        json.loads(identity['document'])
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        log.warning(
+            f'Unable to load instance identity from {cache_file}: '
+            f'{str(error)}'
+        )
+        return
+
+    if not _is_complete_identity(identity):
+        log.warning(f'Incomplete instance identity in {cache_file}')
+        return
+
+    with _identity_lock:
+        _identity.clear()
+        _identity.update(
+            {option: identity[option] for option in IDENTITY_OPTIONS}
+        )
+
+    log.info(f'Loaded instance identity from {cache_file}')
+
+
+def _fetch_metadata(uri, request_header, retry=True):
+    """
+    Return the response of the metadata request.
+
+    If the token is rejected the request is retried once with
+    a fresh token.
+    """
+    path = f'/latest/dynamic/instance-identity/{uri}'
 
     try:
-        value = urllib.request.urlopen(data_request).read()
-    except urllib.error.URLError as error:
-        log.error(f'Failed to retrieve metadata for: {url}. {str(error)}')
+        with metrics.timer('imds_metadata_seconds', resource=uri):
+            status, value = _imds_request('GET', path, request_header)
+    except IMDS_CONNECTION_ERRORS as error:
+        log.error(f'Failed to retrieve metadata for: {path}. {str(error)}')
+        metrics.inc('imds_metadata_failures_total', resource=uri)
+        return None
+
+    if status == 401 and retry:
+        log.info('Metadata token rejected, requesting a new token')
+        return _fetch_metadata(
+            uri,
+            _get_api_header(refresh=True),
+            retry=False
+        )
+    elif status != 200:
+        log.error(
+            f'Failed to retrieve metadata for: {path}. HTTP Error {status}'
+        )
+        metrics.inc('imds_metadata_failures_total', resource=uri)
         return None
 
     return value.decode()
@@ -327,3 +2521,43 @@ def _fetch_metadata(uri, request_header):
 @csp_billing_adapter.hookimpl
 def get_version():
     return ('amazon_plugin', __version__)
+
+
+def _reset():
+    """
+    Drop all cached state so the next call starts cold
+
+    The journal is closed, the metrics server stopped and the buffer
+    is no longer flushed at exit. Used by the tests and benchmarks.
+    """
+    global _buffer, _imds_breaker, _journal, _metrics_server
+
+    _clients.clear()
+
+    for profile in list(_sessions):
+        _reset_session(profile)
+
+    _rate_limiters.clear()
+    _breakers.clear()
+    _imds_breaker = None
+    _reset_ip_addr()
+    _reset_api_token()
+    _identity.clear()
+    _ecs_task_metadata.clear()
+    _close_imds_connections()
+    _dedup_index.clear()
+
+    if _journal:
+        _journal.close()
+
+    _journal = None
+    _journal_wakeup.clear()
+
+    _buffer = None
+    _buffer_wakeup.clear()
+
+    if _metrics_server:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+
+    _metrics_server = None
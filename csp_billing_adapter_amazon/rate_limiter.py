@@ -0,0 +1,103 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements a client side rate limiter used to pace the requests sent
+to the AWS Marketplace metering API.
+"""
+
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket rate limiter
+
+    Tokens are added at the current rate, in requests per second,
+    up to the burst size and each request consumes one token. When
+    throttling is observed the rate is halved, down to min_rate, and
+    each successful request raises it again by a fraction of the
+    configured rate. This lets adapters sharing a quota converge on
+    their share of it.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = None,
+        min_rate: float = None,
+        decrease_factor: float = 0.5,
+        increase_factor: float = 0.05
+    ):
+        if rate <= 0:
+            raise ValueError('Rate must be greater than 0')
+
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.min_rate = min_rate or rate / 10
+        self.decrease_factor = decrease_factor
+        self.increase_factor = increase_factor
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout: float = None):
+        """
+        Wait until a token is available and consume it
+
+        Return False if no token became available within the timeout.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                wait = (1 - self.tokens) / self.rate
+
+            if end is not None:
+                if now + wait > end:
+                    return False
+
+            time.sleep(wait)
+
+    def on_throttle(self):
+        """Lower the rate after a throttled request"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+
+    def on_success(self):
+        """Raise the rate back towards the configured rate"""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(
+                    self.max_rate,
+                    self.rate + self.max_rate * self.increase_factor
+                )
@@ -0,0 +1,54 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements the result record yielded for each metered usage record.
+"""
+
+from typing import NamedTuple
+
+
+class MeteringResult(NamedTuple):
+    """
+    Outcome of a single usage record
+
+    The status is submitted, failed, queued or buffered. Failed
+    records have an error message and the AWS error code if the
+    failure was caused by one. The latency is the time in seconds
+    from the start of the request until the outcome was known,
+    including retries.
+    """
+
+    customer_id: str
+    dimension: str
+    status: str
+    record_id: str = None
+    error: str = None
+    error_code: str = None
+    latency: float = 0
+
+    def to_status(self):
+        """Return the status dictionary of the meter_billing API"""
+        if self.status == 'failed':
+            return {
+                'error': self.error,
+                'status': self.status
+            }
+
+        return {
+            'record_id': self.record_id,
+            'status': self.status
+        }
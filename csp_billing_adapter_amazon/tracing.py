@@ -0,0 +1,76 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Implements optional OpenTelemetry tracing for the plugin.
+
+Spans are only recorded if the opentelemetry-api package is installed
+and an SDK tracer provider is configured by the application, otherwise
+they are no-ops.
+"""
+
+from contextlib import contextmanager
+
+from csp_billing_adapter_amazon import __version__
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+TRACER_NAME = 'csp_billing_adapter_amazon'
+
+
+class _NoopSpan:
+    """Stand-in span used when OpenTelemetry is not installed"""
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_noop_span = _NoopSpan()
+
+
+def get_tracer():
+    """Return the plugin tracer or None without OpenTelemetry"""
+    if trace is None:
+        return None
+
+    return trace.get_tracer(TRACER_NAME, __version__)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Run the block in a new span, a child of the current span
+
+    Attributes with a None value are omitted. Exceptions raised in
+    the block are recorded on the span and set its error status.
+    """
+    tracer = get_tracer()
+
+    if tracer is None:
+        yield _noop_span
+        return
+
+    with tracer.start_as_current_span(
+        name,
+        attributes={
+            key: value for key, value in attributes.items()
+            if value is not None
+        }
+    ) as current_span:
+        yield current_span
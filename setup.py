@@ -57,7 +57,8 @@ setup(
     install_requires=requirements,
     extras_require={
         'dev': dev_requirements,
-        'test': test_requirements
+        'test': test_requirements,
+        'tracing': ['opentelemetry-api']
     },
     license='Apache-2.0',
     zip_safe=False,
@@ -0,0 +1,35 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from csp_billing_adapter_amazon import metrics, plugin
+
+
+def reset_state():
+    plugin._reset()
+    metrics.registry.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_plugin_state(monkeypatch):
+    # The region and identity must not come from the test environment
+    monkeypatch.delenv('AWS_REGION', raising=False)
+    monkeypatch.delenv('AWS_DEFAULT_REGION', raising=False)
+    monkeypatch.delenv('ECS_CONTAINER_METADATA_URI_V4', raising=False)
+    reset_state()
+    yield
+    reset_state()
@@ -0,0 +1,143 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import datetime
+
+from unittest.mock import patch
+
+from csp_billing_adapter_amazon import aio
+from csp_billing_adapter_amazon.results import MeteringResult
+from csp_billing_adapter.config import Config
+from csp_billing_adapter.adapter import get_plugin_manager
+
+pm = get_plugin_manager()
+config = Config.load_from_file(
+    'tests/data/good_config.yaml',
+    pm.hook
+)
+
+
+@patch('csp_billing_adapter_amazon.plugin.meter_billing')
+def test_meter_billing(mock_meter_billing):
+    mock_meter_billing.return_value = {
+        'tier_1': {'record_id': '0123456789', 'status': 'submitted'}
+    }
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = asyncio.run(
+        aio.meter_billing(config, {'tier_1': 10}, timestamp, dry_run=True)
+    )
+
+    assert status['tier_1']['record_id'] == '0123456789'
+    mock_meter_billing.assert_called_once_with(
+        config,
+        {'tier_1': 10},
+        timestamp,
+        True,
+        customer_id=None
+    )
+
+
+@patch('csp_billing_adapter_amazon.plugin.meter_billing_customers')
+def test_meter_billing_customers(mock_meter_billing_customers):
+    mock_meter_billing_customers.return_value = {'123xyz': {}}
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = asyncio.run(
+        aio.meter_billing_customers(config, {'123xyz': {}}, timestamp)
+    )
+
+    assert status == {'123xyz': {}}
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_account_info')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+def test_get_region_and_account_info(mock_get_region, mock_get_account_info):
+    mock_get_region.return_value = 'us-east-1'
+    mock_get_account_info.return_value = {'cloud_provider': 'amazon'}
+
+    async def get_info():
+        return await asyncio.gather(
+            aio.get_region(),
+            aio.get_account_info(config)
+        )
+
+    region, info = asyncio.run(get_info())
+
+    assert region == 'us-east-1'
+    assert info == {'cloud_provider': 'amazon'}
+
+
+@patch('csp_billing_adapter_amazon.plugin.iter_meter_billing')
+def test_iter_meter_billing(mock_iter_meter_billing):
+    closed = []
+
+    def results(*args):
+        try:
+            for dimension in ('tier_1', 'tier_2', 'tier_3'):
+                yield MeteringResult(None, dimension, 'submitted', dimension)
+        finally:
+            closed.append(True)
+
+    mock_iter_meter_billing.side_effect = results
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    async def get_results():
+        dimensions = []
+        async for result in aio.iter_meter_billing(
+            config,
+            {'tier_1': 10, 'tier_2': 0, 'tier_3': 0},
+            timestamp,
+            dry_run=True
+        ):
+            dimensions.append(result.dimension)
+
+            if len(dimensions) == 2:
+                break
+
+        return dimensions
+
+    assert asyncio.run(get_results()) == ['tier_1', 'tier_2']
+    assert closed == [True]
+
+
+@patch('csp_billing_adapter_amazon.plugin.iter_meter_billing_customers')
+def test_iter_meter_billing_customers(mock_iter_meter_billing_customers):
+    mock_iter_meter_billing_customers.return_value = (
+        result for result in [
+            MeteringResult('123xyz', 'tier_1', 'submitted', '0123456789')
+        ]
+    )
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    async def get_results():
+        return [
+            result async for result in aio.iter_meter_billing_customers(
+                config,
+                {'123xyz': {'tier_1': 10}},
+                timestamp
+            )
+        ]
+
+    results = asyncio.run(get_results())
+
+    assert results[0].record_id == '0123456789'
+    mock_iter_meter_billing_customers.assert_called_once_with(
+        config,
+        {'123xyz': {'tier_1': 10}},
+        timestamp
+    )
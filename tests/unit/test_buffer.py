@@ -0,0 +1,79 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from datetime import datetime, timedelta, timezone
+
+from csp_billing_adapter_amazon.buffer import UsageBuffer, get_hour
+
+timestamp = datetime(2023, 6, 1, 10, 15, tzinfo=timezone.utc)
+
+
+def test_buffer_add():
+    buffer = UsageBuffer()
+    buffer.add({'123xyz': {'tier_1': 10}, None: {'tier_2': 1}}, timestamp)
+    buffer.add(
+        {'123xyz': {'tier_1': 5}},
+        timestamp + timedelta(minutes=30)
+    )
+    buffer.add({'123xyz': {'tier_1': 7}}, timestamp + timedelta(hours=1))
+
+    assert len(buffer) == 3
+
+    # Only the hours before the given time are returned
+    entries = buffer.pop(timestamp + timedelta(hours=1))
+    assert entries == [
+        {
+            'customer_id': '123xyz',
+            'dimension': 'tier_1',
+            'hour': '2023-06-01T10',
+            'quantity': 15,
+            'timestamp': timestamp + timedelta(minutes=30)
+        },
+        {
+            'customer_id': None,
+            'dimension': 'tier_2',
+            'hour': '2023-06-01T10',
+            'quantity': 1,
+            'timestamp': timestamp
+        }
+    ]
+    assert len(buffer) == 1
+
+    buffer.restore(entries[:1])
+    assert [entry['quantity'] for entry in buffer.pop()] == [7, 15]
+    assert len(buffer) == 0
+
+
+def test_buffer_persisted(tmp_path):
+    path = str(tmp_path / 'buffer.json')
+    buffer = UsageBuffer(path)
+    buffer.add({'123xyz': {'tier_1': 10}}, timestamp)
+    buffer.add({'123xyz': {'tier_1': 5}}, timestamp)
+
+    entries = UsageBuffer(path).pop()
+    assert len(entries) == 1
+    assert entries[0]['quantity'] == 15
+    assert entries[0]['timestamp'] == timestamp
+
+    buffer.pop()
+    assert len(UsageBuffer(path)) == 0
+
+
+def test_get_hour():
+    local = timezone(timedelta(hours=2))
+
+    assert get_hour(timestamp) == '2023-06-01T10'
+    assert get_hour(timestamp.astimezone(local)) == '2023-06-01T10'
@@ -0,0 +1,87 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from unittest.mock import patch
+
+from csp_billing_adapter_amazon.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker
+)
+
+
+def test_invalid_threshold():
+    with pytest.raises(ValueError):
+        CircuitBreaker(0)
+
+
+@patch('csp_billing_adapter_amazon.circuit_breaker.time.monotonic')
+def test_circuit_breaker(mock_monotonic):
+    mock_monotonic.return_value = 0
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    assert breaker.allow()
+    assert not breaker.on_failure()
+    breaker.on_success()
+
+    # Only consecutive failures open the circuit
+    assert not breaker.on_failure()
+    assert breaker.on_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    # A single probe is allowed after the timeout
+    mock_monotonic.return_value = 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    # A failed probe opens the circuit again
+    assert breaker.on_failure()
+    assert not breaker.allow()
+
+    mock_monotonic.return_value = 60
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+@patch('csp_billing_adapter_amazon.circuit_breaker.time.monotonic')
+def test_circuit_breaker_probe_not_sent(mock_monotonic):
+    mock_monotonic.return_value = 0
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.on_failure()
+
+    mock_monotonic.return_value = 30
+    assert breaker.allow()
+
+    # A released probe is handed to the next caller
+    breaker.release()
+    assert breaker.state == OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # A probe without an outcome is given up after the timeout
+    mock_monotonic.return_value = 59
+    assert not breaker.allow()
+    mock_monotonic.return_value = 60
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.state == CLOSED
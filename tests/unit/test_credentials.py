@@ -0,0 +1,127 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+import time
+
+from botocore.credentials import (
+    Credentials,
+    ReadOnlyCredentials,
+    RefreshableCredentials
+)
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+
+from csp_billing_adapter_amazon.credentials import SharedCredentialsProvider
+from csp_billing_adapter_amazon.metrics import registry
+
+
+def get_credentials(access_key, expires_in=None):
+    expiry = None
+    if expires_in is not None:
+        expiry = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+
+    credentials = Mock(_expiry_time=expiry)
+    credentials.get_frozen_credentials.return_value = ReadOnlyCredentials(
+        access_key,
+        'secret',
+        'token'
+    )
+    return credentials
+
+
+@patch('csp_billing_adapter_amazon.credentials.Session')
+def test_load_static(mock_session):
+    mock_session.return_value.get_credentials.return_value = \
+        get_credentials('static')
+    provider = SharedCredentialsProvider('default')
+
+    credentials = provider.load()
+    provider.load()
+
+    assert isinstance(credentials, Credentials)
+    assert credentials.access_key == 'static'
+    assert credentials.method == 'shared-cache'
+    assert provider.thread is None
+    mock_session.assert_called_once_with(profile='default')
+    assert registry.get_histogram('credentials_refresh_seconds')['count'] == 1
+
+
+@patch('csp_billing_adapter_amazon.credentials.Session')
+def test_load_refreshable(mock_session):
+    mock_session.return_value.get_credentials.return_value = \
+        get_credentials('temporary', expires_in=3600)
+    provider = SharedCredentialsProvider()
+
+    credentials = provider.load()
+
+    try:
+        assert isinstance(credentials, RefreshableCredentials)
+        assert credentials.get_frozen_credentials().access_key == \
+            'temporary'
+        assert provider.thread.is_alive()
+        assert 2300 < provider._get_refresh_delay() <= 2400
+    finally:
+        provider.stop()
+        provider.thread.join()
+
+
+@patch('csp_billing_adapter_amazon.credentials.Session')
+def test_background_refresh(mock_session):
+    mock_session.return_value.get_credentials.side_effect = [
+        get_credentials('expiring', expires_in=600),
+        Exception('STS unavailable'),
+        get_credentials('refreshed', expires_in=3600)
+    ]
+    provider = SharedCredentialsProvider(retry_delay=0.01)
+
+    assert provider.get_metadata()['access_key'] == 'expiring'
+
+    try:
+        for _ in range(100):
+            if provider.metadata['access_key'] == 'refreshed':
+                break
+            time.sleep(0.01)
+    finally:
+        provider.stop()
+        provider.thread.join()
+
+    assert provider.get_metadata()['access_key'] == 'refreshed'
+    assert registry.get_counter('credentials_refresh_failures_total') == 1
+    assert registry.get_histogram('credentials_refresh_seconds')['count'] == 3
+
+
+@patch('csp_billing_adapter_amazon.credentials.Session')
+def test_load_no_credentials(mock_session):
+    mock_session.return_value.get_credentials.return_value = None
+    provider = SharedCredentialsProvider()
+
+    with pytest.raises(Exception, match='Unable to locate credentials'):
+        provider.load()
+
+    assert registry.get_counter('credentials_refresh_failures_total') == 1
+
+
+def test_create_session(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    provider = SharedCredentialsProvider()
+
+    session = provider.create_session()
+    resolver = session.get_component('credential_provider')
+
+    assert resolver.providers[0] is provider
+    assert session.get_credentials().method == 'shared-cache'
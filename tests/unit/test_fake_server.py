@@ -0,0 +1,146 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+import pytest
+
+from unittest.mock import patch
+
+from csp_billing_adapter_amazon import plugin
+from csp_billing_adapter_amazon.fake_server import FakeAWSServer
+from csp_billing_adapter.config import Config
+from csp_billing_adapter.adapter import get_plugin_manager
+
+pm = get_plugin_manager()
+config = Config.load_from_file(
+    'tests/data/good_config.yaml',
+    pm.hook
+)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with FakeAWSServer(seed=1) as server:
+        monkeypatch.setenv('AWS_EC2_METADATA_SERVICE_ENDPOINT', server.url)
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+        yield server
+
+
+def get_config(server, **options):
+    return Config({
+        **config,
+        'metering_endpoint_url': server.url,
+        **options
+    })
+
+
+def test_get_account_info(server):
+    info = plugin.get_account_info(config)
+
+    assert info['document']['region'] == 'us-east-1'
+    assert info['signature'] == 'fake-signature'
+    assert info['pkcs7'] == 'fake-pkcs7'
+    assert server.requests == {'token': 1, 'metadata': 3}
+
+
+def test_token_revoked(server):
+    plugin._get_api_header()
+    server.revoke_tokens()
+
+    assert plugin._fetch_metadata(
+        'signature',
+        plugin._get_api_header()
+    ) == 'fake-signature'
+    assert server.requests['token'] == 2
+
+
+def test_meter_billing(server):
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        get_config(server),
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=False
+    )
+
+    assert status['tier_1']['status'] == 'submitted'
+    assert status['tier_2']['record_id']
+    assert server.requests['MeterUsage'] == 2
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+def test_batch_meter_billing_unprocessed(mock_sleep, server):
+    server.unprocessed_rate = 0.5
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    usage = {
+        f'customer_{index}': {'tier_1': 10, 'tier_2': 0}
+        for index in range(20)
+    }
+
+    status = plugin.meter_billing_customers(
+        get_config(server, metering_retry_attempts=10),
+        usage,
+        timestamp
+    )
+
+    assert all(
+        dim_status['status'] == 'submitted'
+        for customer_status in status.values()
+        for dim_status in customer_status.values()
+    )
+    assert server.requests['BatchMeterUsage'] > 2
+
+
+def test_meter_billing_throttled(server):
+    server.throttle_rate = 1
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        get_config(
+            server,
+            metering_retry_attempts=2,
+            metering_retry_base_delay=0
+        ),
+        {'tier_1': 10},
+        timestamp,
+        dry_run=False
+    )
+
+    assert status['tier_1']['status'] == 'failed'
+    assert 'ThrottlingException' in status['tier_1']['error']
+
+
+def test_unknown_requests(server):
+    server.error_rate = 1
+    connection = plugin.HTTPConnection(server.url[len('http://'):-1])
+
+    connection.request('GET', '/latest/meta-data/')
+    assert connection.getresponse().read() == b'Not Found'
+
+    connection.request('PUT', '/latest/api/token')
+    response = connection.getresponse()
+    assert response.status == 400
+    response.read()
+
+    connection.request('POST', '/', body=b'{}', headers={
+        'X-Amz-Target': 'AWSMPMeteringService.MeterUsage'
+    })
+    response = connection.getresponse()
+    assert response.status == 500
+    assert b'InternalServiceErrorException' in response.read()
+    connection.close()
@@ -0,0 +1,73 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+
+from csp_billing_adapter_amazon.journal import MeteringJournal, QUEUED
+
+timestamp = datetime.datetime(2024, 1, 1, 10, tzinfo=datetime.timezone.utc)
+
+
+def test_journal(tmp_path):
+    journal = MeteringJournal(str(tmp_path / 'journal.db'))
+    entry_ids = journal.append([
+        ('123xyz', 'tier_1', 10, timestamp),
+        (None, 'tier_2', 0, timestamp)
+    ])
+    queued_id, = journal.append([('123xyz', 'tier_3', 5, timestamp)], QUEUED)
+
+    # Pending entries of this process are in flight
+    assert [entry['id'] for entry in journal.get_unsubmitted()] == \
+        [queued_id]
+
+    journal.acknowledge(entry_ids[0], '0123456789')
+    journal.fail(entry_ids[1], 'ThrottlingException')
+
+    entries = journal.get_unsubmitted()
+    assert entries[0] == {
+        'id': entry_ids[1],
+        'customer_id': None,
+        'dimension': 'tier_2',
+        'quantity': 0,
+        'timestamp': timestamp,
+        'error_code': 'ThrottlingException'
+    }
+    assert len(entries) == 2
+
+    # Rejected entries are never resubmitted
+    rejected_id, = journal.append([('456abc', 'tier_1', 1, timestamp)])
+    journal.reject(rejected_id, 'CustomerNotSubscribed')
+    assert len(journal.get_unsubmitted()) == 2
+
+    # Give up on entries that failed too many times
+    assert len(journal.get_unsubmitted(max_attempts=1)) == 1
+
+    journal.prune(-1)
+    journal.close()
+
+
+def test_journal_restart(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = MeteringJournal(path)
+    entry_id, = journal.append([('123xyz', 'tier_1', 10, timestamp)])
+    journal.close()
+
+    # Pending entries of a previous process are resubmitted
+    journal = MeteringJournal(path)
+    journal.opened += 1
+    assert [entry['id'] for entry in journal.get_unsubmitted()] == \
+        [entry_id]
+    journal.close()
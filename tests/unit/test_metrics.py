@@ -0,0 +1,134 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from unittest.mock import Mock, patch
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from csp_billing_adapter_amazon.metrics import Metrics
+
+
+def test_counter():
+    metrics = Metrics()
+    metrics.inc('retries_total', dimension='tier_1')
+    metrics.inc('retries_total', 2, dimension='tier_1')
+    metrics.inc('retries_total', dimension='tier_2')
+
+    assert metrics.get_counter('retries_total', dimension='tier_1') == 3
+    assert metrics.get_counter('retries_total', dimension='tier_2') == 1
+    assert metrics.get_counter('retries_total') == 0
+
+
+def test_histogram():
+    metrics = Metrics(buckets=(0.1, 1))
+    assert metrics.get_histogram('request_seconds') is None
+
+    for value in (0.05, 0.1, 0.5, 5):
+        metrics.observe('request_seconds', value)
+
+    assert metrics.get_histogram('request_seconds') == {
+        'buckets': {0.1: 2, 1: 3},
+        'count': 4,
+        'sum': 5.65
+    }
+
+
+@patch('csp_billing_adapter_amazon.metrics.time.perf_counter')
+def test_timer(mock_perf_counter):
+    mock_perf_counter.side_effect = [1, 1.5]
+    metrics = Metrics()
+
+    with pytest.raises(ValueError):
+        with metrics.timer('request_seconds', operation='meter'):
+            raise ValueError('Failed')
+
+    # The duration is observed when the block raises
+    histogram = metrics.get_histogram('request_seconds', operation='meter')
+    assert histogram['count'] == 1
+    assert histogram['sum'] == 0.5
+
+
+def test_callback():
+    metrics = Metrics()
+    callback = Mock()
+    failing_callback = Mock(side_effect=Exception('Broken'))
+    metrics.add_callback(failing_callback)
+    metrics.add_callback(callback)
+
+    metrics.inc('retries_total', dimension='tier_1')
+    metrics.observe('request_seconds', 0.2)
+
+    callback.assert_any_call(
+        'counter',
+        'retries_total',
+        1,
+        {'dimension': 'tier_1'}
+    )
+    callback.assert_any_call('histogram', 'request_seconds', 0.2, {})
+    assert failing_callback.call_count == 2
+
+    metrics.remove_callback(callback)
+    metrics.inc('retries_total')
+    assert callback.call_count == 2
+
+
+def test_render():
+    metrics = Metrics(buckets=(0.1, 1))
+    assert metrics.render() == ''
+
+    metrics.inc('retries_total', dimension='tier "1"')
+    metrics.observe('request_seconds', 0.5, operation='meter')
+
+    assert metrics.render() == (
+        '# TYPE csp_billing_adapter_amazon_retries_total counter\n'
+        'csp_billing_adapter_amazon_retries_total'
+        '{dimension="tier \\"1\\""} 1\n'
+        '# TYPE csp_billing_adapter_amazon_request_seconds histogram\n'
+        'csp_billing_adapter_amazon_request_seconds_bucket'
+        '{operation="meter",le="0.1"} 0\n'
+        'csp_billing_adapter_amazon_request_seconds_bucket'
+        '{operation="meter",le="1"} 1\n'
+        'csp_billing_adapter_amazon_request_seconds_bucket'
+        '{operation="meter",le="+Inf"} 1\n'
+        'csp_billing_adapter_amazon_request_seconds_sum'
+        '{operation="meter"} 0.5\n'
+        'csp_billing_adapter_amazon_request_seconds_count'
+        '{operation="meter"} 1\n'
+    )
+
+    metrics.reset()
+    assert metrics.render() == ''
+
+
+def test_serve():
+    metrics = Metrics()
+    metrics.inc('retries_total')
+    httpd = metrics.serve(0)
+    url = f'http://127.0.0.1:{httpd.server_address[1]}'
+
+    try:
+        with urlopen(f'{url}/metrics') as response:
+            body = response.read().decode()
+
+        with pytest.raises(HTTPError):
+            urlopen(f'{url}/other')
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert 'csp_billing_adapter_amazon_retries_total 1' in body
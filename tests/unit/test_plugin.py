@@ -15,12 +15,20 @@
 #
 
 import datetime
+import json
 import pytest
-import urllib.error
+import socket
+import subprocess
+import sys
+import threading
+import time
 
+from botocore.exceptions import ClientError
 from unittest.mock import Mock, patch
+from urllib.request import urlopen
 
 from csp_billing_adapter_amazon import plugin
+from csp_billing_adapter_amazon.metrics import registry
 from csp_billing_adapter.config import Config
 from csp_billing_adapter.adapter import get_plugin_manager
 
@@ -31,8 +39,102 @@ config = Config.load_from_file(
 )
 
 
-def test_setup():
-    plugin.setup_adapter(config)  # Currently no-op
+IDENTITY = {
+    'document': '{"region": "us-east-1"}',
+    'signature': 'signature',
+    'pkcs7': 'pkcs7'
+}
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+def test_setup(mock_get_metadata):
+    mock_get_metadata.return_value = dict(IDENTITY)
+    plugin.setup_adapter(config)
+
+    assert plugin.get_region() == 'us-east-1'
+    assert plugin.get_account_info(config)['signature'] == 'signature'
+    assert mock_get_metadata.call_count == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_client')
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+def test_setup_prewarm(mock_get_metadata, mock_get_client):
+    mock_get_metadata.return_value = dict(IDENTITY)
+    plugin.setup_adapter(Config({**config, 'metering_prewarm': True}))
+
+    for thread in threading.enumerate():
+        if thread.name == 'metering-prewarm':
+            thread.join()
+
+    mock_get_client.assert_called_once()
+    assert mock_get_client.call_args.args[1] == 'us-east-1'
+
+
+def test_import_does_not_load_boto3():
+    output = subprocess.check_output([
+        sys.executable,
+        '-c',
+        'import sys, csp_billing_adapter_amazon.plugin; '
+        'print("boto3" in sys.modules, "botocore" in sys.modules)'
+    ])
+
+    assert output.split() == [b'False', b'False']
+
+
+@patch('csp_billing_adapter_amazon.plugin.BotoConfig', None)
+@patch('csp_billing_adapter_amazon.plugin.boto3', None)
+def test_load_boto3():
+    plugin._load_boto3()
+
+    assert plugin.boto3.__name__ == 'boto3'
+    assert plugin.BotoConfig.__module__ == 'botocore.config'
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+def test_setup_metrics_port(mock_get_metadata):
+    mock_get_metadata.return_value = dict(IDENTITY)
+    plugin.setup_adapter(Config({**config, 'metrics_port': 0}))
+
+    registry.inc('metering_records_total', dimension='tier_1')
+    port = plugin._metrics_server.server_address[1]
+
+    with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+        body = response.read().decode()
+
+    assert 'metering_records_total{dimension="tier_1"} 1' in body
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+def test_setup_identity_cache_file(mock_get_metadata, tmp_path):
+    cache_file = str(tmp_path / 'identity.json')
+    file_config = Config({**config, 'identity_cache_file': cache_file})
+
+    mock_get_metadata.return_value = dict(IDENTITY)
+    plugin.setup_adapter(file_config)
+    plugin._identity.clear()
+    plugin._close_imds_connections()
+
+    # Metadata service unavailable, fall back to the cache file
+    mock_get_metadata.side_effect = Exception('Failed to retrieve token')
+    plugin.setup_adapter(file_config)
+
+    assert plugin.get_region() == 'us-east-1'
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+def test_setup_identity_incomplete(mock_get_metadata, tmp_path):
+    cache_file = tmp_path / 'identity.json'
+    cache_file.write_text('{"document": "{}"}')
+    file_config = Config({**config, 'identity_cache_file': str(cache_file)})
+
+    mock_get_metadata.return_value = {
+        'document': None,
+        'signature': None,
+        'pkcs7': None
+    }
+    plugin.setup_adapter(file_config)
+
+    assert plugin._identity == {}
 
 
 @patch('csp_billing_adapter_amazon.plugin.get_region')
@@ -40,7 +142,7 @@ def test_setup():
 def test_meter_billing(mock_boto3, mock_get_region):
     client = Mock()
     client.meter_usage.return_value = {'MeteringRecordId': '0123456789'}
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -58,12 +160,17 @@ def test_meter_billing(mock_boto3, mock_get_region):
     assert status['tier_1']['status'] == 'submitted'
 
 
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
 @patch('csp_billing_adapter_amazon.plugin.get_region')
 @patch('csp_billing_adapter_amazon.plugin.boto3')
-def test_meter_billing_error(mock_boto3, mock_get_region):
+def test_meter_billing_error(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep
+):
     client = Mock()
     client.meter_usage.side_effect = Exception('Failed to meter bill!')
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -86,16 +193,107 @@ def test_get_csp_name():
     assert plugin.get_csp_name(config) == 'amazon'
 
 
-@patch('csp_billing_adapter_amazon.plugin.urllib.request.urlopen')
-def test_get_account_info(mock_urlopen):
-    urlopen = Mock()
-    urlopen.read.side_effect = [
-        b'secrettoken',
-        b'{"some": "info"}',
-        b'signature',
-        b'pkcs7'
-    ]
-    mock_urlopen.return_value = urlopen
+def set_client(mock_boto3, client):
+    """Make the mocked boto3 session return the metering client"""
+    mock_boto3.session.Session.return_value.client.return_value = client
+
+
+def imds_connection(responses):
+    """Return a mock metadata connection answering with the responses"""
+    connection = Mock()
+    connection.sock = None
+
+    def connect():
+        connection.sock = Mock()
+
+    def close():
+        connection.sock = None
+
+    def getresponse():
+        response = responses.pop(0)
+
+        if isinstance(response, Exception):
+            raise response
+
+        status, body = response
+        return Mock(
+            status=status,
+            will_close=False,
+            read=Mock(return_value=body)
+        )
+
+    connection.connect.side_effect = connect
+    connection.close.side_effect = close
+    connection.getresponse.side_effect = getresponse
+    return connection
+
+
+def imds_server(responses):
+    """Return mock metadata connections answering by request path"""
+    def connection(*args, **kwargs):
+        connection = Mock()
+        connection.sock = None
+
+        def connect():
+            connection.sock = Mock()
+
+        def getresponse():
+            path = connection.request.call_args.args[1]
+            response = responses[path]
+
+            if isinstance(response, Exception):
+                raise response
+
+            status, body = response
+            return Mock(
+                status=status,
+                will_close=False,
+                read=Mock(return_value=body)
+            )
+
+        connection.connect.side_effect = connect
+        connection.getresponse.side_effect = getresponse
+        return connection
+
+    return connection
+
+
+IDENTITY_PATH = '/latest/dynamic/instance-identity/'
+
+
+@patch('csp_billing_adapter_amazon.plugin._request_api_token')
+def test_get_account_info_unavailable(mock_request_api_token):
+    mock_request_api_token.side_effect = Exception('Metadata unavailable')
+
+    with pytest.raises(Exception, match='Unable to retrieve account info'):
+        plugin.get_account_info(config)
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+def test_get_account_info_incomplete(mock_get_metadata):
+    mock_get_metadata.return_value = {
+        **IDENTITY,
+        'signature': None,
+        'pkcs7': None
+    }
+
+    # The unsigned identity is not returned
+    with pytest.raises(Exception, match='Unable to retrieve account info'):
+        plugin.get_account_info(
+            Config({**config, 'identity_resolvers': ['imds']})
+        )
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_account_info(mock_connection, mock_get_ip_addr):
+    mock_get_ip_addr.return_value = '169.254.169.254'
+    mock_connection.side_effect = imds_server({
+        '/latest/api/token': (200, b'secrettoken'),
+        IDENTITY_PATH + 'document': (200, b'{"some": "info"}'),
+        IDENTITY_PATH + 'signature': (200, b'signature'),
+        IDENTITY_PATH + 'pkcs7': (200, b'pkcs7')
+    })
 
     info = plugin.get_account_info(config)
     assert info == {
@@ -105,49 +303,248 @@ def test_get_account_info(mock_urlopen):
         'signature': 'signature'
     }
 
+    # Connections are kept alive for reuse
+    assert mock_connection.call_count <= 3
+    assert mock_connection.call_count == \
+        len(plugin._imds_connections['169.254.169.254'])
+
+
+@patch('csp_billing_adapter_amazon.plugin._fetch_metadata')
+@patch('csp_billing_adapter_amazon.plugin._get_api_header')
+def test_get_metadata_timeout(mock_get_header, mock_fetch_metadata):
+    release = threading.Event()
+
+    def fetch_metadata(uri, request_header):
+        if uri == 'pkcs7':
+            release.wait(5)
+        return uri
+
+    mock_get_header.return_value = {'header': 'data'}
+    mock_fetch_metadata.side_effect = fetch_metadata
+
+    with patch.dict(plugin._imds_settings, {'metadata_timeout': 0.1}):
+        metadata = plugin._get_metadata()
+
+    release.set()
+    assert metadata == {
+        'document': 'document',
+        'signature': 'signature',
+        'pkcs7': None
+    }
+    assert mock_get_header.call_count == 1
+
 
 @patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
-@patch('csp_billing_adapter_amazon.plugin.urllib.request.urlopen')
-def test_get_api_header_token_fail(mock_urlopen, mock_get_ip_addr):
-    urlopen = Mock()
-    urlopen.read.side_effect = [
-        urllib.error.URLError('Cannot get token!')
-    ]
-    mock_urlopen.return_value = urlopen
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_api_header_token_fail(mock_connection, mock_get_ip_addr):
+    mock_connection.return_value = imds_connection([
+        ConnectionRefusedError('Cannot get token!')
+    ])
 
     with pytest.raises(Exception):
         plugin._get_api_header()
 
+    assert registry.get_counter('imds_token_failures_total') == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_api_header_token_timeout(mock_connection, mock_get_ip_addr):
+    mock_connection.return_value = imds_connection([
+        socket.timeout('timed out')
+    ])
+
+    with pytest.raises(Exception, match='hop limit'):
+        plugin._get_api_header()
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_api_header_token_forbidden(mock_connection, mock_get_ip_addr):
+    mock_connection.return_value = imds_connection([(403, b'Forbidden')])
+
+    with pytest.raises(Exception, match='HTTP Error 403'):
+        plugin._get_api_header()
+
 
-@patch('csp_billing_adapter_amazon.plugin.urllib.request.urlopen')
-def test_get_api_header_token_ok(mock_urlopen):
-    urlopen = Mock()
-    urlopen.read.return_value = b'foo'
-    mock_urlopen.return_value = urlopen
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_api_header_token_ok(mock_connection, mock_get_ip_addr):
+    mock_connection.return_value = imds_connection([(200, b'foo')])
 
     header = plugin._get_api_header()
     assert header == {'X-aws-ec2-metadata-token': 'foo'}
 
 
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_api_header_cached(mock_connection, mock_get_ip_addr):
+    connection = imds_connection([(200, b'foo'), (200, b'bar')])
+    mock_connection.return_value = connection
+
+    assert plugin._get_api_header() == {'X-aws-ec2-metadata-token': 'foo'}
+    assert plugin._get_api_header() == {'X-aws-ec2-metadata-token': 'foo'}
+    assert connection.request.call_count == 1
+
+    assert plugin._get_api_header(refresh=True) == \
+        {'X-aws-ec2-metadata-token': 'bar'}
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.time.monotonic')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_api_header_expired(
+    mock_connection,
+    mock_monotonic,
+    mock_get_ip_addr
+):
+    mock_connection.return_value = imds_connection([
+        (200, b'foo'),
+        (200, b'bar')
+    ])
+    mock_monotonic.side_effect = [0, 21400, 21400]
+
+    assert plugin._get_api_header() == {'X-aws-ec2-metadata-token': 'foo'}
+    assert plugin._get_api_header() == {'X-aws-ec2-metadata-token': 'bar'}
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_fetch_metadata_token_rejected(mock_connection, mock_get_ip_addr):
+    connection = imds_connection([
+        (401, b'Unauthorized'),
+        (200, b'newtoken'),
+        (200, b'document')
+    ])
+    mock_connection.return_value = connection
+
+    value = plugin._fetch_metadata(
+        'document',
+        {'X-aws-ec2-metadata-token': 'oldtoken'}
+    )
+    assert value == 'document'
+    assert connection.request.call_args.kwargs['headers'] == {
+        'X-aws-ec2-metadata-token': 'newtoken'
+    }
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_imds_request_stale_connection(mock_connection, mock_get_ip_addr):
+    mock_get_ip_addr.return_value = '169.254.169.254'
+    stale = imds_connection([
+        (200, b'token'),
+        ConnectionResetError('Connection reset by peer')
+    ])
+    fresh = imds_connection([(200, b'document')])
+    mock_connection.side_effect = [stale, fresh]
+
+    assert plugin._imds_request('PUT', '/latest/api/token', {}) == \
+        (200, b'token')
+    assert plugin._imds_request('GET', '/document', {}) == \
+        (200, b'document')
+    stale.close.assert_called_once_with()
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_imds_connection_pool_limit(mock_connection, mock_get_ip_addr):
+    mock_get_ip_addr.return_value = '169.254.169.254'
+    connections = [
+        imds_connection([(200, b'data')]) for _ in range(5)
+    ]
+    mock_connection.side_effect = connections
+
+    for connection in connections:
+        plugin._send_imds_request(
+            connection,
+            '169.254.169.254',
+            'GET',
+            '/document',
+            {}
+        )
+
+    assert len(plugin._imds_connections['169.254.169.254']) == 4
+    connections[-1].close.assert_called_once_with()
+
+
+@patch.dict('csp_billing_adapter_amazon.plugin._imds_settings')
+def test_configure_imds():
+    plugin._configure_imds(Config({**config, 'imds_read_timeout': 5}))
+    assert plugin._imds_settings['read_timeout'] == 5
+    assert plugin._imds_settings['connect_timeout'] == 1
+
+
 @patch('csp_billing_adapter_amazon.plugin.create_connection')
 def test_get_ipv6_addr(mock_create_connection):
     ipv6_addr = plugin._get_ip_addr()
     assert ipv6_addr == '[fd00:ec2::254]'
 
 
+@patch('csp_billing_adapter_amazon.plugin.create_connection')
+def test_get_ip_addr_memoized(mock_create_connection):
+    assert plugin._get_ip_addr() == '[fd00:ec2::254]'
+    probes = mock_create_connection.call_count
+
+    assert plugin._get_ip_addr() == '[fd00:ec2::254]'
+    assert mock_create_connection.call_count == probes
+
+
+@patch('csp_billing_adapter_amazon.plugin.create_connection')
+def test_get_ipv4_addr_fallback(mock_create_connection):
+    def connect(address, timeout):
+        if address[0] == 'fd00:ec2::254':
+            raise OSError('Network is unreachable')
+        return Mock()
+
+    mock_create_connection.side_effect = connect
+    assert plugin._get_ip_addr() == '169.254.169.254'
+
+
+@patch('csp_billing_adapter_amazon.plugin.create_connection')
+def test_probe_endpoint_timeout(mock_create_connection):
+    mock_create_connection.side_effect = socket.timeout('timed out')
+
+    assert plugin._probe_endpoint('169.254.169.254') is False
+    mock_create_connection.assert_called_once()
+
+
+@patch('csp_billing_adapter_amazon.plugin.create_connection')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_fetch_metadata_reprobe(mock_connection, mock_create_connection):
+    mock_connection.side_effect = [
+        imds_connection([ConnectionRefusedError('Connection refused')]),
+        imds_connection([(200, b'document')])
+    ]
+
+    assert plugin._fetch_metadata('document', {}) is None
+    assert plugin._imds_ip_addr is None
+
+    assert plugin._fetch_metadata('document', {}) == 'document'
+    assert plugin._imds_ip_addr == '[fd00:ec2::254]'
+
+
 @patch('csp_billing_adapter_amazon.plugin.has_ipv6', False)
 def test_get_ipv4_addr():
     ipv4_addr = plugin._get_ip_addr()
     assert ipv4_addr == '169.254.169.254'
 
 
-@patch('csp_billing_adapter_amazon.plugin.urllib.request.urlopen')
-def test_fetch_metadata_fail(mock_urlopen):
-    urlopen = Mock()
-    urlopen.read.side_effect = [
-        urllib.error.URLError('Cannot get metadata!')
-    ]
-    mock_urlopen.return_value = urlopen
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_fetch_metadata_fail(mock_connection, mock_get_ip_addr):
+    mock_connection.return_value = imds_connection([
+        ConnectionRefusedError('Cannot get metadata!')
+    ])
+
+    metadata = plugin._fetch_metadata('metadata', {'header': 'data'})
+    assert metadata is None
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_fetch_metadata_not_found(mock_connection, mock_get_ip_addr):
+    mock_connection.return_value = imds_connection([(404, b'Not Found')])
 
     metadata = plugin._fetch_metadata('metadata', {'header': 'data'})
     assert metadata is None
@@ -173,6 +570,108 @@ def test_get_region_bad_data(mock_get_header, mock_fetch_metadata):
         plugin.get_region()
 
 
+ECS_TASK = {
+    'AvailabilityZone': 'us-west-2b',
+    'Cluster': 'default',
+    'LaunchType': 'FARGATE',
+    'TaskARN': 'arn:aws:ecs:us-west-2:123456789012:task/default/abc'
+}
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_identity')
+def test_get_region_config(mock_get_identity, monkeypatch):
+    monkeypatch.setenv('AWS_REGION', 'eu-west-1')
+
+    region = plugin.get_region(Config({**config, 'aws_region': 'us-west-1'}))
+    assert region == 'us-west-1'
+
+    assert plugin.get_region(config) == 'eu-west-1'
+    mock_get_identity.assert_not_called()
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_identity')
+def test_get_region_resolvers(mock_get_identity, monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-1')
+    mock_get_identity.return_value = dict(IDENTITY)
+
+    assert plugin.get_region() == 'eu-west-1'
+    assert plugin.get_region(
+        Config({**config, 'region_resolvers': ['imds']})
+    ) == 'us-east-1'
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_identity')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_region_ecs(mock_connection, mock_get_identity, monkeypatch):
+    monkeypatch.setenv(
+        'ECS_CONTAINER_METADATA_URI_V4',
+        'http://169.254.170.2/v4/abc'
+    )
+    connection = imds_connection([(200, json.dumps(ECS_TASK).encode())])
+    mock_connection.return_value = connection
+
+    assert plugin.get_region(config) == 'us-west-2'
+    assert plugin.get_region(config) == 'us-west-2'
+
+    # The task metadata is cached
+    mock_connection.assert_called_once_with('169.254.170.2', timeout=1)
+    connection.request.assert_called_once_with('GET', '/v4/abc/task')
+    mock_get_identity.assert_not_called()
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_identity')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_region_ecs_error(
+    mock_connection,
+    mock_get_identity,
+    monkeypatch
+):
+    monkeypatch.setenv(
+        'ECS_CONTAINER_METADATA_URI_V4',
+        'http://169.254.170.2/v4/abc'
+    )
+    mock_connection.return_value = imds_connection([(500, b'Error')])
+    mock_get_identity.return_value = dict(IDENTITY)
+
+    assert plugin.get_region(config) == 'us-east-1'
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_metadata')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_get_account_info_ecs(
+    mock_connection,
+    mock_get_metadata,
+    monkeypatch
+):
+    monkeypatch.setenv(
+        'ECS_CONTAINER_METADATA_URI_V4',
+        'http://169.254.170.2/v4/abc'
+    )
+    mock_connection.return_value = imds_connection([
+        (200, json.dumps(ECS_TASK).encode())
+    ])
+    mock_get_metadata.return_value = {
+        'document': None,
+        'signature': None,
+        'pkcs7': None
+    }
+
+    info = plugin.get_account_info(config)
+    assert info == {
+        'cloud_provider': 'amazon',
+        'document': {
+            'accountId': '123456789012',
+            'availabilityZone': 'us-west-2b',
+            'cluster': 'default',
+            'launchType': 'FARGATE',
+            'region': 'us-west-2',
+            'taskArn': ECS_TASK['TaskARN']
+        },
+        'pkcs7': None,
+        'signature': None
+    }
+
+
 def test_get_version():
     version = plugin.get_version()
     assert version[0] == 'amazon_plugin'
@@ -196,7 +695,7 @@ def test_batch_meter_billing(mock_boto3, mock_get_region):
             'Status': 'Success'
         }]
     }
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -215,12 +714,13 @@ def test_batch_meter_billing(mock_boto3, mock_get_region):
     assert status['tier_1']['status'] == 'submitted'
 
 
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
 @patch('csp_billing_adapter_amazon.plugin.get_region')
 @patch('csp_billing_adapter_amazon.plugin.boto3')
-def test_batch_meter_billing_error(mock_boto3, mock_get_region):
+def test_batch_meter_billing_error(mock_boto3, mock_get_region, mock_sleep):
     client = Mock()
     client.batch_meter_usage.side_effect = Exception('Failed to meter bill!')
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -241,9 +741,14 @@ def test_batch_meter_billing_error(mock_boto3, mock_get_region):
     assert status['tier_1']['status'] == 'failed'
 
 
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
 @patch('csp_billing_adapter_amazon.plugin.get_region')
 @patch('csp_billing_adapter_amazon.plugin.boto3')
-def test_batch_meter_billing_unprocessed(mock_boto3, mock_get_region):
+def test_batch_meter_billing_unprocessed(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep
+):
     timestamp = datetime.datetime.now(datetime.timezone.utc)
     client = Mock()
     client.batch_meter_usage.return_value = {
@@ -254,7 +759,7 @@ def test_batch_meter_billing_unprocessed(mock_boto3, mock_get_region):
             'Quantity': 10
         }]
     }
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -291,7 +796,7 @@ def test_batch_meter_billing_no_subscribe(mock_boto3, mock_get_region):
             'Status': 'CustomerNotSubscribed'
         }]
     }
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -327,7 +832,7 @@ def test_batch_meter_billing_no_status(mock_boto3, mock_get_region):
             'MeteringRecordId': '0123456789'
         }]
     }
-    mock_boto3.client.return_value = client
+    set_client(mock_boto3, client)
 
     mock_get_region.return_value = 'us-east-1'
 
@@ -345,3 +850,1281 @@ def test_batch_meter_billing_no_status(mock_boto3, mock_get_region):
     msg = 'Status unknown for dimension: tier_1'
     assert status['tier_1']['error'] == msg
     assert status['tier_1']['status'] == 'failed'
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_reuses_client(mock_boto3, mock_get_region):
+    client = Mock()
+    client.meter_usage.return_value = {'MeteringRecordId': '0123456789'}
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    dimensions = {'tier_1': 10, 'tier_2': 0}
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    for _ in range(2):
+        plugin.meter_billing(config, dimensions, timestamp, dry_run=True)
+
+    session = mock_boto3.session.Session.return_value
+    assert session.client.call_count == 1
+    assert mock_boto3.session.Session.call_count == 1
+    assert client.meter_usage.call_count == 4
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_expired_credentials(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep
+):
+    expired = ClientError(
+        {'Error': {'Code': 'ExpiredTokenException', 'Message': 'Expired'}},
+        'MeterUsage'
+    )
+    expired_client = Mock()
+    expired_client.meter_usage.side_effect = expired
+    client = Mock()
+    client.meter_usage.return_value = {'MeteringRecordId': '0123456789'}
+    session = mock_boto3.session.Session.return_value
+    session.client.side_effect = [expired_client, client]
+
+    mock_get_region.return_value = 'us-east-1'
+
+    dimensions = {'tier_1': 10}
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        config,
+        dimensions,
+        timestamp,
+        dry_run=True
+    )
+
+    assert status['tier_1']['record_id'] == '0123456789'
+    assert session.client.call_count == 2
+
+    # The session is re-created to resolve the credentials again
+    assert mock_boto3.session.Session.call_count == 2
+
+
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_invalidate_client_profile(mock_boto3):
+    session = mock_boto3.session.Session.return_value
+    session.client.side_effect = lambda *args, **kwargs: Mock()
+
+    east = plugin._get_client(config, 'us-east-1')
+    west = plugin._get_client(config, 'us-west-2')
+
+    plugin._invalidate_client(config, 'us-east-1')
+
+    # Every client of the profile used the stopped credentials provider
+    assert plugin._get_client(config, 'us-east-1') is not east
+    assert plugin._get_client(config, 'us-west-2') is not west
+    assert mock_boto3.session.Session.call_count == 2
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_concurrent(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep
+):
+    def meter_usage(**kwargs):
+        if kwargs['UsageDimension'] == 'tier_2':
+            raise Exception('Failed to meter bill!')
+        return {'MeteringRecordId': kwargs['UsageDimension']}
+
+    client = Mock()
+    client.meter_usage.side_effect = meter_usage
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    dimensions = {'tier_1': 10, 'tier_2': 0, 'tier_3': 0}
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    concurrent_config = Config({**config, 'metering_max_workers': 3})
+
+    status = plugin.meter_billing(
+        concurrent_config,
+        dimensions,
+        timestamp,
+        dry_run=True
+    )
+
+    assert list(status) == ['tier_1', 'tier_2', 'tier_3']
+    assert status['tier_1']['record_id'] == 'tier_1'
+    assert status['tier_2']['status'] == 'failed'
+    assert status['tier_3']['record_id'] == 'tier_3'
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_usage(mock_boto3, mock_sleep):
+    def meter_usage(**kwargs):
+        if kwargs['UsageDimension'] == 'tier_2':
+            raise Exception('Failed to meter bill!')
+        return {'MeteringRecordId': kwargs['UsageDimension']}
+
+    client = Mock()
+    client.meter_usage.side_effect = meter_usage
+    set_client(mock_boto3, client)
+
+    status = {}
+    plugin.meter_usage(
+        status,
+        config,
+        'us-east-1',
+        datetime.datetime.now(datetime.timezone.utc),
+        {'tier_1': 10, 'tier_2': 5},
+        True
+    )
+
+    assert status['tier_1'] == {'record_id': 'tier_1', 'status': 'submitted'}
+    assert status['tier_2']['status'] == 'failed'
+
+
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_batch_meter_usage(mock_boto3):
+    def batch_meter_usage(UsageRecords, ProductCode):
+        return {
+            'Results': [{
+                'UsageRecord': record,
+                'MeteringRecordId': record['Dimension'],
+                'Status': 'Success'
+            } for record in UsageRecords]
+        }
+
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_meter_usage
+    set_client(mock_boto3, client)
+
+    status = {}
+    plugin.batch_meter_usage(
+        status,
+        config,
+        'us-east-1',
+        datetime.datetime.now(datetime.timezone.utc),
+        {'tier_1': 10, 'tier_2': 5},
+        '123xyz'
+    )
+
+    assert status == {
+        'tier_1': {'record_id': 'tier_1', 'status': 'submitted'},
+        'tier_2': {'record_id': 'tier_2', 'status': 'submitted'}
+    }
+    records = client.batch_meter_usage.call_args.kwargs['UsageRecords']
+    assert records[0]['CustomerIdentifier'] == '123xyz'
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_batch_meter_billing_chunked(mock_boto3, mock_get_region):
+    def batch_meter_usage(UsageRecords, ProductCode):
+        return {
+            'Results': [{
+                'UsageRecord': record,
+                'MeteringRecordId': record['Dimension'],
+                'Status': 'Success'
+            } for record in UsageRecords]
+        }
+
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_meter_usage
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    dimensions = {f'dimension_{index}': index for index in range(30)}
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        config,
+        dimensions,
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+
+    batch_sizes = [
+        len(call.kwargs['UsageRecords'])
+        for call in client.batch_meter_usage.call_args_list
+    ]
+    assert batch_sizes == [25, 5]
+    assert len(status) == 30
+    assert status['dimension_29']['record_id'] == 'dimension_29'
+    assert client.batch_meter_usage.call_args_list[0].kwargs[
+        'UsageRecords'][0]['Timestamp'] == timestamp
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_customers(mock_boto3, mock_get_region):
+    def batch_meter_usage(UsageRecords, ProductCode):
+        return {
+            'Results': [{
+                'UsageRecord': record,
+                'MeteringRecordId': record['CustomerIdentifier'],
+                'Status': 'Success'
+            } for record in UsageRecords]
+        }
+
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_meter_usage
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    usage = {
+        f'customer_{index}': {'tier_1': 10, 'tier_2': 0}
+        for index in range(20)
+    }
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing_customers(config, usage, timestamp)
+
+    assert client.batch_meter_usage.call_count == 2
+    assert len(status) == 20
+    assert status['customer_0']['tier_1']['record_id'] == 'customer_0'
+    assert status['customer_0']['tier_2']['record_id'] == 'customer_0'
+    assert status['customer_19']['tier_2']['status'] == 'submitted'
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_batch_meter_billing_retry_unprocessed(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep
+):
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    throttled = ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'Throttled'}},
+        'BatchMeterUsage'
+    )
+
+    def result(record):
+        return {
+            'UsageRecord': record,
+            'MeteringRecordId': record['Dimension'],
+            'Status': 'Success'
+        }
+
+    def batch_meter_usage(UsageRecords, ProductCode):
+        if client.batch_meter_usage.call_count == 1:
+            return {
+                'Results': [result(UsageRecords[0])],
+                'UnprocessedRecords': UsageRecords[1:]
+            }
+        elif client.batch_meter_usage.call_count == 2:
+            raise throttled
+
+        return {'Results': [result(record) for record in UsageRecords]}
+
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_meter_usage
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+
+    assert status['tier_1']['record_id'] == 'tier_1'
+    assert status['tier_2']['record_id'] == 'tier_2'
+    assert client.batch_meter_usage.call_count == 3
+    assert [
+        len(call.kwargs['UsageRecords'])
+        for call in client.batch_meter_usage.call_args_list
+    ] == [2, 1, 1]
+    assert mock_sleep.call_count == 2
+
+    assert registry.get_counter(
+        'metering_retries_total',
+        dimension='tier_2'
+    ) == 2
+    assert registry.get_counter(
+        'metering_throttles_total',
+        dimension='tier_2'
+    ) == 1
+    assert registry.get_counter(
+        'metering_records_total',
+        dimension='tier_2'
+    ) == 1
+    assert registry.get_histogram('batch_meter_usage_seconds')['count'] == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_batch_meter_billing_permanent_error(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep
+):
+    client = Mock()
+    client.batch_meter_usage.side_effect = ClientError(
+        {
+            'Error': {
+                'Code': 'InvalidProductCodeException',
+                'Message': 'Invalid product code'
+            }
+        },
+        'BatchMeterUsage'
+    )
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False,
+        customer_id='123xyz'
+    )
+
+    assert status['tier_1']['status'] == 'failed'
+    assert client.batch_meter_usage.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+def test_get_backoff_delay():
+    for attempt in range(1, 10):
+        assert 0 <= plugin._get_backoff_delay(config, attempt) <= 10
+
+    retry_config = Config({
+        **config,
+        'metering_retry_base_delay': 1,
+        'metering_retry_max_delay': 5,
+        'metering_retry_jitter': False
+    })
+    assert [
+        plugin._get_backoff_delay(retry_config, attempt)
+        for attempt in range(1, 5)
+    ] == [1, 2, 4, 5]
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_retry_policy(mock_boto3, mock_get_region, mock_sleep):
+    throttled = ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'Throttled'}},
+        'MeterUsage'
+    )
+    duplicate = ClientError(
+        {'Error': {'Code': 'DuplicateRequestException', 'Message': 'Dupe'}},
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = [throttled] * 4 + [duplicate] * 2
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    retry_config = Config({**config, 'metering_retry_attempts': 5})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        retry_config,
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=True
+    )
+
+    # Throttled 4 times then a permanent error, tier_2 is not retried
+    assert status['tier_1']['status'] == 'failed'
+    assert 'DuplicateRequestException' in status['tier_1']['error']
+    assert status['tier_2']['status'] == 'failed'
+    assert client.meter_usage.call_count == 6
+    assert mock_sleep.call_count == 4
+
+    assert registry.get_counter(
+        'metering_throttles_total',
+        dimension='tier_1'
+    ) == 4
+    assert registry.get_counter(
+        'metering_retries_total',
+        dimension='tier_1'
+    ) == 4
+    assert registry.get_counter(
+        'metering_failures_total',
+        dimension='tier_1'
+    ) == 1
+    assert registry.get_counter(
+        'metering_errors_total',
+        operation='meter_usage',
+        code='ThrottlingException'
+    ) == 4
+    assert registry.get_histogram(
+        'metering_request_seconds',
+        operation='meter_usage'
+    )['count'] == 6
+
+
+@patch('csp_billing_adapter_amazon.tracing.trace')
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin._get_identity')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_spans(
+    mock_boto3,
+    mock_get_identity,
+    mock_sleep,
+    mock_trace
+):
+    throttled = ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'Throttled'}},
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = [throttled, {'MeteringRecordId': '1'}]
+    set_client(mock_boto3, client)
+    mock_get_identity.return_value = dict(IDENTITY)
+
+    tracer = mock_trace.get_tracer.return_value
+    current_span = \
+        tracer.start_as_current_span.return_value.__enter__.return_value
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=True
+    )
+
+    assert status['tier_1']['status'] == 'submitted'
+    assert [
+        call.args[0] for call in tracer.start_as_current_span.call_args_list
+    ] == [
+        'meter_billing',
+        'get_region',
+        'metering.meter_usage',
+        'metering.meter_usage'
+    ]
+    assert tracer.start_as_current_span.call_args_list[2].kwargs[
+        'attributes'
+    ] == {
+        'aws.region': 'us-east-1',
+        'metering.dimension': 'tier_1',
+        'metering.record_count': 1
+    }
+    current_span.set_attribute.assert_any_call('aws.region', 'us-east-1')
+    current_span.set_attribute.assert_any_call(
+        'aws.error_code',
+        'ThrottlingException'
+    )
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.monotonic')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_deadline(
+    mock_boto3,
+    mock_get_region,
+    mock_monotonic
+):
+    client = Mock()
+    client.meter_usage.side_effect = Exception('Failed to meter bill!')
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+    mock_monotonic.side_effect = [0, 1, 100]
+
+    deadline_config = Config({**config, 'metering_deadline': 60})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        deadline_config,
+        {'tier_1': 10},
+        timestamp,
+        dry_run=True
+    )
+
+    assert status['tier_1']['status'] == 'failed'
+    assert client.meter_usage.call_count == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_rate_limited(mock_boto3, mock_get_region, mock_sleep):
+    throttled = ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'Throttled'}},
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = [
+        throttled,
+        {'MeteringRecordId': '0123456789'}
+    ]
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    rate_config = Config({**config, 'metering_rate_limit': 100})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    with patch.object(plugin.RateLimiter, 'acquire') as mock_acquire:
+        status = plugin.meter_billing(
+            rate_config,
+            {'tier_1': 10},
+            timestamp,
+            dry_run=True
+        )
+
+    assert status['tier_1']['record_id'] == '0123456789'
+    assert mock_acquire.call_count == 2
+    assert plugin._rate_limiters['us-east-1'].rate == 55
+
+
+def batch_results(UsageRecords, ProductCode):
+    return {
+        'Results': [{
+            'UsageRecord': record,
+            'MeteringRecordId': record['Dimension'],
+            'Status': 'Success'
+        } for record in UsageRecords]
+    }
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_journal_drainer')
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_journal(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep,
+    mock_drainer,
+    tmp_path
+):
+    client = Mock()
+    client.meter_usage.side_effect = [
+        {'MeteringRecordId': '0123456789'},
+        Exception('Failed to meter bill!'),
+        Exception('Failed to meter bill!'),
+        Exception('Failed to meter bill!'),
+        {'MeteringRecordId': '9876543210'}
+    ]
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    journal_config = Config({
+        **config,
+        'metering_journal_path': str(tmp_path / 'journal.db')
+    })
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        journal_config,
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=False
+    )
+
+    # The failed dimension is left to the journal
+    assert status['tier_1']['status'] == 'submitted'
+    assert status['tier_2'] == {'record_id': None, 'status': 'queued'}
+    mock_drainer.assert_called_once()
+
+    journal = plugin._journal
+    entries = journal.get_unsubmitted()
+    assert [entry['dimension'] for entry in entries] == ['tier_2']
+
+    plugin._drain_journal(journal_config, journal)
+    assert journal.get_unsubmitted() == []
+    assert client.meter_usage.call_args.kwargs['Timestamp'] == timestamp
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_journal_drainer')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_journal_async(
+    mock_boto3,
+    mock_get_region,
+    mock_drainer,
+    tmp_path
+):
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_results
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    journal_config = Config({
+        **config,
+        'metering_journal_path': str(tmp_path / 'journal.db'),
+        'metering_journal_async': True
+    })
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        journal_config,
+        {'tier_1': 10},
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+    customers_status = plugin.meter_billing_customers(
+        journal_config,
+        {'456abc': {'tier_1': 5}},
+        timestamp
+    )
+
+    assert status == {'tier_1': {'record_id': None, 'status': 'queued'}}
+    assert customers_status['456abc']['tier_1']['status'] == 'queued'
+    assert plugin._journal_wakeup.is_set()
+    client.batch_meter_usage.assert_not_called()
+
+    plugin._drain_journal(journal_config, plugin._journal)
+
+    # Both customers are coalesced into one batch
+    assert client.batch_meter_usage.call_count == 1
+    assert plugin._journal.get_unsubmitted() == []
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_journal_drainer')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_journal_permanent_error(
+    mock_boto3,
+    mock_get_region,
+    mock_drainer,
+    tmp_path
+):
+    invalid = ClientError(
+        {
+            'Error': {
+                'Code': 'InvalidUsageDimensionException',
+                'Message': 'Invalid dimension'
+            }
+        },
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = invalid
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    journal_config = Config({
+        **config,
+        'metering_journal_path': str(tmp_path / 'journal.db')
+    })
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        journal_config,
+        {'tier_1': 10},
+        timestamp,
+        dry_run=False
+    )
+
+    # The failure is returned to the caller and not resubmitted
+    assert status['tier_1']['status'] == 'failed'
+    assert plugin._journal.get_unsubmitted() == []
+
+    # Entries that failed with a permanent error are not resubmitted
+    entry_id, = plugin._journal.append([(None, 'tier_2', 5, timestamp)])
+    plugin._journal.fail(entry_id, 'InvalidUsageDimensionException')
+    plugin._drain_journal(journal_config, plugin._journal)
+
+    assert client.meter_usage.call_count == 1
+    assert plugin._journal.get_unsubmitted() == []
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_journal_drainer')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+def test_meter_billing_journal_region_error(
+    mock_get_region,
+    mock_drainer,
+    tmp_path
+):
+    mock_get_region.side_effect = Exception('Unable to retrieve region.')
+
+    journal_config = Config({
+        **config,
+        'metering_journal_path': str(tmp_path / 'journal.db')
+    })
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        journal_config,
+        {'tier_1': 10},
+        timestamp,
+        dry_run=False
+    )
+
+    assert status == {'tier_1': {'record_id': None, 'status': 'queued'}}
+    assert len(plugin._journal.get_unsubmitted()) == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_dedup(mock_boto3, mock_get_region):
+    duplicate = ClientError(
+        {'Error': {'Code': 'DuplicateRequestException', 'Message': 'Dupe'}},
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = [
+        {'MeteringRecordId': '0123456789'},
+        duplicate
+    ]
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    dedup_config = Config({**config, 'metering_dedup': True})
+    timestamp = datetime.datetime(
+        2024, 1, 1, 10, 5, tzinfo=datetime.timezone.utc
+    )
+
+    status = plugin.meter_billing(
+        dedup_config,
+        {'tier_1': 10},
+        timestamp,
+        dry_run=False
+    )
+    assert status['tier_1']['record_id'] == '0123456789'
+
+    # Same hour, already acknowledged
+    status = plugin.meter_billing(
+        dedup_config,
+        {'tier_1': 10},
+        timestamp + datetime.timedelta(minutes=30),
+        dry_run=False
+    )
+    assert status['tier_1']['record_id'] == '0123456789'
+    assert client.meter_usage.call_count == 1
+
+    # Next hour, rejected as a duplicate by the API
+    status = plugin.meter_billing(
+        dedup_config,
+        {'tier_1': 10},
+        timestamp + datetime.timedelta(hours=1),
+        dry_run=False
+    )
+    assert status['tier_1'] == {'record_id': None, 'status': 'submitted'}
+    assert client.meter_usage.call_count == 2
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_batch_meter_billing_dedup(mock_boto3, mock_get_region):
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_results
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    dedup_config = Config({**config, 'metering_dedup': True})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    plugin.meter_billing(
+        dedup_config,
+        {'tier_1': 10},
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+    status = plugin.meter_billing(
+        dedup_config,
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+
+    assert status['tier_1']['record_id'] == 'tier_1'
+    assert status['tier_2']['record_id'] == 'tier_2'
+    assert [
+        record['Dimension']
+        for record in client.batch_meter_usage.call_args.kwargs[
+            'UsageRecords'
+        ]
+    ] == ['tier_2']
+
+
+@patch('csp_billing_adapter_amazon.plugin.DEDUP_INDEX_SIZE', 2)
+def test_dedup_index_eviction():
+    for index in range(3):
+        plugin._set_acknowledged(('foo', None, f'tier_{index}', 'hour'), index)
+
+    assert list(plugin._dedup_index.values()) == [1, 2]
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_buffer_flusher')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_buffer(
+    mock_boto3,
+    mock_get_region,
+    mock_flusher
+):
+    client = Mock()
+    client.meter_usage.return_value = {'MeteringRecordId': '0123456789'}
+    client.batch_meter_usage.side_effect = batch_results
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    buffer_config = Config({**config, 'metering_buffer': True})
+    now = datetime.datetime.now(datetime.timezone.utc)
+    last_hour = now - datetime.timedelta(hours=1)
+
+    status = plugin.meter_billing(
+        buffer_config,
+        {'tier_1': 10},
+        last_hour,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+    plugin.meter_billing(
+        buffer_config,
+        {'tier_1': 5},
+        last_hour,
+        dry_run=False,
+        customer_id='123xyz'
+    )
+    customers_status = plugin.meter_billing_customers(
+        buffer_config,
+        {'456abc': {'tier_1': 1}},
+        last_hour
+    )
+    plugin.meter_billing(buffer_config, {'tier_2': 3}, last_hour, False)
+    plugin.meter_billing(buffer_config, {'tier_2': 4}, now, False)
+
+    assert status == {'tier_1': {'record_id': None, 'status': 'buffered'}}
+    assert customers_status['456abc']['tier_1']['status'] == 'buffered'
+    client.meter_usage.assert_not_called()
+    client.batch_meter_usage.assert_not_called()
+
+    # Only the hour that has ended is flushed
+    plugin._flush_buffer(buffer_config, plugin._buffer)
+
+    client.meter_usage.assert_called_once()
+    assert client.meter_usage.call_args.kwargs['UsageQuantity'] == 3
+    client.batch_meter_usage.assert_called_once()
+    assert sorted(
+        (record['CustomerIdentifier'], record['Quantity'])
+        for record in client.batch_meter_usage.call_args.kwargs[
+            'UsageRecords'
+        ]
+    ) == [('123xyz', 15), ('456abc', 1)]
+    assert len(plugin._buffer) == 1
+
+    # Everything is flushed at exit
+    plugin._flush_buffer(buffer_config, plugin._buffer, due=False)
+    assert client.meter_usage.call_count == 2
+    assert len(plugin._buffer) == 0
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_buffer_flusher')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+def test_flush_buffer_error(mock_get_region, mock_flusher):
+    mock_get_region.side_effect = Exception('Unable to retrieve region')
+
+    buffer_config = Config({**config, 'metering_buffer': True})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    plugin.meter_billing_customers(
+        buffer_config,
+        {'123xyz': {'tier_1': 10}},
+        timestamp
+    )
+    plugin._flush_buffer(buffer_config, plugin._buffer, due=False)
+
+    # The usage is kept for the next flush
+    assert plugin._buffer.pop()[0]['quantity'] == 10
+
+
+@patch('csp_billing_adapter_amazon.plugin._flush_buffer')
+@patch('csp_billing_adapter_amazon.plugin._register_atexit')
+@patch('csp_billing_adapter_amazon.plugin._run_buffer_flusher')
+def test_buffer_exit_flush(
+    mock_flusher,
+    mock_register,
+    mock_flush_buffer,
+    tmp_path
+):
+    buffer_config = Config({**config, 'metering_buffer': True})
+    buffer = plugin._get_buffer(buffer_config)
+    assert mock_register.call_args.args == (
+        plugin._flush_buffer_at_exit,
+        buffer_config,
+        buffer
+    )
+
+    plugin._flush_buffer_at_exit(buffer_config, buffer)
+    mock_flush_buffer.assert_called_once_with(buffer_config, buffer, False)
+
+    # Saved buffers keep the current hour at exit
+    mock_flush_buffer.reset_mock()
+    buffer_config = Config({
+        **buffer_config,
+        'metering_buffer_path': str(tmp_path / 'buffer.json')
+    })
+    plugin._flush_buffer_at_exit(buffer_config, buffer)
+    mock_flush_buffer.assert_called_once_with(buffer_config, buffer, True)
+
+    # Dropped buffers are not flushed
+    mock_flush_buffer.reset_mock()
+    plugin._reset()
+    plugin._flush_buffer_at_exit(buffer_config, buffer)
+    mock_flush_buffer.assert_not_called()
+
+
+def test_buffer_exit_flush_concurrent():
+    script = (
+        'import atexit, datetime\n'
+        'from unittest.mock import Mock\n'
+        'from csp_billing_adapter.config import Config\n'
+        'from csp_billing_adapter_amazon import plugin\n'
+        'client = Mock()\n'
+        'client.meter_usage.return_value = {"MeteringRecordId": "0123"}\n'
+        'atexit.register(lambda: print(client.meter_usage.call_count))\n'
+        'plugin._get_client = Mock(return_value=client)\n'
+        'plugin._run_buffer_flusher = Mock()\n'
+        'config = Config({\n'
+        '    "aws_region": "us-east-1",\n'
+        '    "product_code": "foo",\n'
+        '    "metering_buffer": True,\n'
+        '    "metering_max_workers": 4\n'
+        '})\n'
+        'plugin.meter_billing(\n'
+        '    config,\n'
+        '    {"tier_1": 10, "tier_2": 5},\n'
+        '    datetime.datetime.now(datetime.timezone.utc),\n'
+        '    dry_run=False\n'
+        ')\n'
+    )
+    output = subprocess.check_output([sys.executable, '-c', script])
+
+    # The buffer is flushed before the thread pools are shut down
+    assert output.split() == [b'2']
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_buffer_flusher')
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_flush_buffer_failed(
+    mock_boto3,
+    mock_get_region,
+    mock_sleep,
+    mock_flusher
+):
+    invalid = ClientError(
+        {
+            'Error': {
+                'Code': 'InvalidUsageDimensionException',
+                'Message': 'Invalid dimension'
+            }
+        },
+        'MeterUsage'
+    )
+
+    def meter_usage(**kwargs):
+        if kwargs['UsageDimension'] == 'tier_1':
+            raise invalid
+        raise Exception('Failed to meter bill!')
+
+    client = Mock()
+    client.meter_usage.side_effect = meter_usage
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    buffer_config = Config({**config, 'metering_buffer': True})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    plugin.meter_billing(
+        buffer_config,
+        {'tier_1': 10, 'tier_2': 5},
+        timestamp,
+        False
+    )
+    plugin._flush_buffer(buffer_config, plugin._buffer, due=False)
+
+    # Only the transient failure is kept for the next flush
+    entries = plugin._buffer.pop()
+    assert [entry['dimension'] for entry in entries] == ['tier_2']
+    assert entries[0]['quantity'] == 5
+
+
+@patch('csp_billing_adapter_amazon.plugin.time.sleep')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_meter_billing_circuit_open(mock_boto3, mock_get_region, mock_sleep):
+    unavailable = ClientError(
+        {
+            'Error': {
+                'Code': 'InternalServiceErrorException',
+                'Message': 'Internal error'
+            }
+        },
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = unavailable
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    breaker_config = Config({**config, 'metering_breaker_threshold': 2})
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        breaker_config,
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=True
+    )
+
+    # The circuit opens on the second failure, no more requests are sent
+    assert client.meter_usage.call_count == 2
+    assert status['tier_1']['status'] == 'failed'
+    assert 'circuit open' in status['tier_2']['error']
+    assert registry.get_counter(
+        'circuit_breaker_opened_total',
+        endpoint='metering'
+    ) == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin._get_ip_addr')
+@patch('csp_billing_adapter_amazon.plugin.HTTPConnection')
+def test_imds_circuit_open(mock_connection, mock_get_ip_addr):
+    mock_connection.side_effect = lambda *args, **kwargs: imds_connection([
+        ConnectionRefusedError('Connection refused')
+    ])
+
+    for _ in range(3):
+        assert plugin._fetch_metadata('document', {}) is None
+
+    assert mock_get_ip_addr.call_count == 3
+
+    # Requests fail fast without probing the endpoint
+    with pytest.raises(Exception, match='Metadata circuit open'):
+        plugin._get_api_header()
+
+    assert mock_get_ip_addr.call_count == 3
+    assert registry.get_counter(
+        'circuit_breaker_rejected_total',
+        endpoint='imds'
+    ) == 1
+
+
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_iter_meter_billing(mock_boto3, mock_get_region):
+    invalid = ClientError(
+        {
+            'Error': {
+                'Code': 'InvalidUsageDimensionException',
+                'Message': 'Invalid dimension'
+            }
+        },
+        'MeterUsage'
+    )
+    client = Mock()
+    client.meter_usage.side_effect = [
+        {'MeteringRecordId': '0123456789'},
+        invalid
+    ]
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    results = plugin.iter_meter_billing(
+        config,
+        {'tier_1': 10, 'tier_2': 0},
+        timestamp,
+        dry_run=True
+    )
+
+    # Nothing is metered until the results are consumed
+    client.meter_usage.assert_not_called()
+
+    result = next(results)
+    assert result.customer_id is None
+    assert result.dimension == 'tier_1'
+    assert result.record_id == '0123456789'
+    assert result.status == 'submitted'
+    assert result.latency >= 0
+    assert client.meter_usage.call_count == 1
+
+    result = next(results)
+    assert result.dimension == 'tier_2'
+    assert result.status == 'failed'
+    assert result.error_code == 'InvalidUsageDimensionException'
+    assert 'Invalid dimension' in result.error
+    assert result.to_status() == {'error': result.error, 'status': 'failed'}
+
+    with pytest.raises(StopIteration):
+        next(results)
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_journal_drainer')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_iter_meter_billing_customers(
+    mock_boto3,
+    mock_get_region,
+    mock_drainer,
+    tmp_path
+):
+    client = Mock()
+    client.batch_meter_usage.side_effect = batch_results
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    journal_config = Config({
+        **config,
+        'metering_journal_path': str(tmp_path / 'journal.db')
+    })
+    usage = {
+        f'customer_{index}': {'tier_1': 10, 'tier_2': 0}
+        for index in range(20)
+    }
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    results = plugin.iter_meter_billing_customers(
+        journal_config,
+        usage,
+        timestamp
+    )
+
+    # The results of the first batch are yielded before the second
+    # batch is submitted
+    first_batch = [next(results) for _ in range(25)]
+    assert client.batch_meter_usage.call_count == 1
+    assert first_batch[0].customer_id == 'customer_0'
+    assert first_batch[0].record_id == 'tier_1'
+    assert all(result.status == 'submitted' for result in first_batch)
+
+    # Records without a result are marked failed when closed early
+    results.close()
+    assert client.batch_meter_usage.call_count == 1
+
+    entries = plugin._journal.get_unsubmitted()
+    assert len(entries) == 15
+    assert entries[0]['customer_id'] == 'customer_12'
+    assert entries[0]['dimension'] == 'tier_2'
+
+
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_call_metering_probe_not_sent(mock_boto3):
+    client = Mock()
+    client.meter_usage.return_value = {'MeteringRecordId': '0123456789'}
+    set_client(mock_boto3, client)
+
+    breaker_config = Config({
+        **config,
+        'metering_breaker_threshold': 1,
+        'metering_rate_limit': 0.001
+    })
+    breaker = plugin._get_breaker(breaker_config, 'us-east-1')
+    breaker.on_failure()
+    breaker.opened -= 30
+
+    limiter = plugin._get_rate_limiter(breaker_config, 'us-east-1')
+    limiter.tokens = 0
+
+    # The probe is given back when the request is not sent
+    with pytest.raises(Exception, match='Metering deadline exceeded'):
+        plugin._call_metering(
+            breaker_config,
+            'us-east-1',
+            'meter_usage',
+            time.monotonic() + 0.01,
+            UsageDimension='tier_1'
+        )
+
+    client.meter_usage.assert_not_called()
+
+    limiter.tokens = 1
+    response = plugin._call_metering(
+        breaker_config,
+        'us-east-1',
+        'meter_usage',
+        UsageDimension='tier_1'
+    )
+
+    assert response['MeteringRecordId'] == '0123456789'
+    assert breaker.state == 'closed'
+
+
+@patch('csp_billing_adapter_amazon.plugin._probe_ip_addr')
+def test_imds_circuit_open_unreachable(mock_probe_ip_addr):
+    mock_probe_ip_addr.return_value = None
+
+    for _ in range(3):
+        with pytest.raises(Exception, match='Metadata endpoint unreachable'):
+            plugin._get_api_header()
+
+    for _ in range(3):
+        with pytest.raises(Exception, match='Metadata circuit open'):
+            plugin._get_api_header()
+
+    # No probe is sent while the circuit is open
+    assert mock_probe_ip_addr.call_count == 3
+    assert plugin._imds_breaker.state == 'open'
+
+
+@patch('csp_billing_adapter_amazon.plugin._run_journal_drainer')
+@patch('csp_billing_adapter_amazon.plugin.get_region')
+@patch('csp_billing_adapter_amazon.plugin.boto3')
+def test_iter_meter_billing_closed_in_flight(
+    mock_boto3,
+    mock_get_region,
+    mock_drainer,
+    tmp_path
+):
+    # All dimensions are in flight before the first result is yielded
+    barrier = threading.Barrier(4, timeout=5)
+
+    def meter_usage(**kwargs):
+        barrier.wait()
+        return {'MeteringRecordId': kwargs['UsageDimension']}
+
+    client = Mock()
+    client.meter_usage.side_effect = meter_usage
+    set_client(mock_boto3, client)
+
+    mock_get_region.return_value = 'us-east-1'
+
+    journal_config = Config({
+        **config,
+        'metering_journal_path': str(tmp_path / 'journal.db'),
+        'metering_max_workers': 4
+    })
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    results = plugin.iter_meter_billing(
+        journal_config,
+        {f'tier_{index}': 10 for index in range(4)},
+        timestamp,
+        dry_run=False
+    )
+    assert next(results).status == 'submitted'
+    results.close()
+
+    # The records in flight are acknowledged, not resubmitted
+    assert client.meter_usage.call_count == 4
+    assert plugin._journal.get_unsubmitted() == []
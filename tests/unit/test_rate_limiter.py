@@ -0,0 +1,66 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from unittest.mock import patch
+
+from csp_billing_adapter_amazon.rate_limiter import RateLimiter
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+
+
+@patch('csp_billing_adapter_amazon.rate_limiter.time.sleep')
+@patch('csp_billing_adapter_amazon.rate_limiter.time.monotonic')
+def test_acquire(mock_monotonic, mock_sleep):
+    mock_monotonic.return_value = 0
+    limiter = RateLimiter(2, burst=2)
+
+    assert limiter.acquire()
+    assert limiter.acquire()
+    mock_sleep.assert_not_called()
+
+    # Bucket is empty, wait for half a second for the next token
+    mock_monotonic.side_effect = [0, 0.5]
+    assert limiter.acquire()
+    mock_sleep.assert_called_once_with(0.5)
+
+
+@patch('csp_billing_adapter_amazon.rate_limiter.time.monotonic')
+def test_acquire_timeout(mock_monotonic):
+    mock_monotonic.return_value = 0
+    limiter = RateLimiter(1, burst=1)
+
+    assert limiter.acquire(timeout=0.1)
+    assert not limiter.acquire(timeout=0.1)
+
+
+def test_adaptive_rate():
+    limiter = RateLimiter(10)
+
+    limiter.on_throttle()
+    assert limiter.rate == 5
+
+    for _ in range(5):
+        limiter.on_throttle()
+    assert limiter.rate == 1
+
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 10
@@ -0,0 +1,49 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from unittest.mock import patch
+
+from csp_billing_adapter_amazon import tracing
+
+
+@patch('csp_billing_adapter_amazon.tracing.trace', None)
+def test_span_noop():
+    assert tracing.get_tracer() is None
+
+    with tracing.span('get_region', region='us-east-1') as current_span:
+        current_span.set_attribute('aws.region', 'us-east-1')
+
+    assert current_span is tracing._noop_span
+
+
+@patch('csp_billing_adapter_amazon.tracing.trace')
+def test_span(mock_trace):
+    tracer = mock_trace.get_tracer.return_value
+
+    with tracing.span('meter_billing', batch=True, dimension=None) as \
+            current_span:
+        pass
+
+    mock_trace.get_tracer.assert_called_once_with(
+        'csp_billing_adapter_amazon',
+        tracing.__version__
+    )
+    tracer.start_as_current_span.assert_called_once_with(
+        'meter_billing',
+        attributes={'batch': True}
+    )
+    assert current_span is \
+        tracer.start_as_current_span.return_value.__enter__.return_value